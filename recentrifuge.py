@@ -4,37 +4,40 @@ Post-process Centrifuge/LMAT output.
 """
 # pylint: disable=no-name-in-module, not-an-iterable
 import argparse
-import collections as col
-import multiprocessing as mp
 import os
 import platform
 import sys
 import time
-from typing import Counter, List, Dict, Set, Callable, Tuple
+from typing import Counter, List, Dict, Set, Callable, Tuple, Optional
 
 from recentrifuge.centrifuge import process_report, process_output
 from recentrifuge.centrifuge import select_centrifuge_inputs
 from recentrifuge.config import Filename, Sample, TaxId, Score, Scoring, Excel
+from recentrifuge.config import Table
 from recentrifuge.config import HTML_SUFFIX, DEFMINTAXA, TAXDUMP_PATH
+from recentrifuge.config import MEM_PER_INPUT_BYTE, BRANCHES_PER_PROCESS
 from recentrifuge.config import NODES_FILE, NAMES_FILE, PLASMID_FILE
 from recentrifuge.config import STR_CONTROL, STR_EXCLUSIVE, STR_SHARED
 from recentrifuge.config import STR_CONTROL_SHARED, Err, SampleStats
 from recentrifuge.config import gray, red, green, yellow, blue, magenta
-from recentrifuge.core import process_rank, summarize_analysis
-from recentrifuge.krona import COUNT, UNASSIGNED, SCORE
+from recentrifuge.core import process_ranks, summarize_analysis, krona_branch
 from recentrifuge.krona import KronaTree
-from recentrifuge.lmat import select_lmat_inputs
+from recentrifuge.lmat import select_lmat_inputs, get_lmat_output_size
+from recentrifuge.outputs import Output, KronaOutput
+from recentrifuge.parallel import Executor
 from recentrifuge.rank import Rank, TaxLevels
+from recentrifuge.tables import WORKBOOK_OPTIONS, write_stats
+from recentrifuge.tables import FullExcel, CountsExcel, TsvTable, NpzTable
 from recentrifuge.taxonomy import Taxonomy
 from recentrifuge.trees import TaxTree, MultiTree, SampleDataByTaxId
 
-# optional package pandas (to generate Excel output)
-_USE_PANDAS = True
+# optional package xlsxwriter (to generate Excel output)
+_USE_XLSXWRITER = True
 try:
-    import pandas as pd
+    import xlsxwriter
 except ImportError:
-    pd = None
-    _USE_PANDAS = False
+    xlsxwriter = None
+    _USE_XLSXWRITER = False
 
 __version__ = '0.18.6'
 __author__ = 'Jose Manuel Marti'
@@ -60,8 +63,8 @@ def _debug_dummy_plot(taxonomy: Taxonomy,
                                  )
     polytree: MultiTree = MultiTree(samples=samples)
     polytree.grow(taxonomy=taxonomy)
-    polytree.toxml(taxonomy=taxonomy, krona=krona)
-    krona.tohtml(htmlfile, pretty=True)
+    krona.tohtml(htmlfile, pretty=True,
+                 nodes=polytree.iter_krona(taxonomy=taxonomy))
     print(green('OK!'))
 
 
@@ -134,6 +137,19 @@ def main():
         )
         parser_output = parser.add_argument_group(
             'output', 'Related to the output files')
+        parser_output.add_argument(
+            '--compact',
+            action='store_true',
+            help=('encode the data of the Krona plot in a sparse, compact '
+                  'way, so the HTML file of many samples is much smaller')
+        )
+        parser_output.add_argument(
+            '--lazy',
+            action='store_true',
+            help=('load the unassigned and score values of each dataset of '
+                  'the Krona plot just when selected (implies --compact); '
+                  'they are spooled to temporary files while writing it')
+        )
         parser_output.add_argument(
             '-e', '--excel',
             action='store',
@@ -143,6 +159,16 @@ def main():
             help=(f'type of scoring to be applied, and can be one of '
                   f'{[str(excel) for excel in Excel]}')
         )
+        parser_output.add_argument(
+            '--table',
+            action='append',
+            metavar='TABLE_TYPE',
+            choices=[str(table) for table in Table],
+            default=[],
+            help=(f'also export the full results in this table format (which '
+                  f'is faster to write and read than Excel), and can be one '
+                  f'of {[str(table) for table in Table]}; it can be repeated')
+        )
         parser_output.add_argument(
             '-o', '--outhtml',
             action='store',
@@ -158,11 +184,25 @@ def main():
             action='store_true',
             help=argparse.SUPPRESS
         )
+        parser_mode.add_argument(
+            '--keeptrees',  # hidden flag: retain the taxonomy tree of samples
+            action='store_true',
+            help=argparse.SUPPRESS
+        )
         parser_mode.add_argument(
             '-g', '--debug',
             action='store_true',
             help='increase output verbosity and perform additional checks'
         )
+        parser_mode.add_argument(
+            '--maxmem',
+            action='store',
+            metavar='GiB',
+            type=float,
+            default=None,
+            help=('limit the number of samples read in parallel so that their '
+                  'estimated memory footprint does not exceed this size')
+        )
         parser_mode.add_argument(
             '--sequential',
             action='store_true',
@@ -311,134 +351,95 @@ def main():
         else:
             htmlfile = Filename(outputs[0].split('_mhl')[0] + HTML_SUFFIX)
 
+    def max_tasks() -> int:
+        """Maximum number of concurrent tasks in any stage of the run"""
+        num_files: int = len(input_files)
+        if num_files < 2 or args.avoidcross:
+            return num_files
+        num_crosses: int = len(Rank.selected_ranks) * num_files
+        num_summaries: int = 2 * num_files + 2  # Upper bound of summaries
+        return max(num_crosses, num_summaries)
+
+    def input_sizes() -> List[int]:
+        """Size in bytes of the input files (all the shards for LMAT)"""
+        if lmats:
+            return [get_lmat_output_size(file) for file in input_files]
+        return [os.stat(file).st_size for file in input_files]
+
     def read_samples():
         """Read samples"""
         print(gray('\nPlease, wait, processing files in parallel...\n'))
-        # Enable parallelization with 'spawn' under known platforms
-        if platform.system() and not args.sequential:  # Only for known systems
-            mpctx = mp.get_context('fork')
-            with mpctx.Pool(processes=min(os.cpu_count(),
-                                          len(input_files))) as pool:
-                async_results = [pool.apply_async(
-                    process,
-                    args=[input_files[num],  # file name
-                          True if num < args.controls else False],  # is ctrl?
-                    kwds=kwargs
-                ) for num in range(len(input_files))]
-                for file, (sample, tree, out, stat, err) in zip(
-                        input_files, [r.get() for r in async_results]):
-                    if err is Err.NO_ERROR:
-                        samples.append(sample)
-                        trees[sample] = tree
-                        taxids[sample] = out.get_taxlevels()
-                        counts[sample] = out.counts
-                        accs[sample] = out.accs
-                        scores[sample] = out.scores
-                        stats[sample] = stat
-                    elif err is Err.VOID_CTRL:
-                        print('There were void controls.', red('Aborting!'))
-                        exit(1)
-        else:  # sequential processing of each sample
-            for num, file in enumerate(input_files):
-                (sample, tree, out, stat, err) = process(
-                    file, True if num < args.controls else False, **kwargs)
-                if err is Err.NO_ERROR:
-                    samples.append(sample)
+        # Largest samples first, optionally limiting their memory footprint
+        sizes: List[int] = input_sizes()
+        max_size: int = None
+        if args.maxmem:
+            max_size = int(args.maxmem * 2**30 / MEM_PER_INPUT_BYTE)
+        for sample, tree, out, stat, err in executor.map(
+                process,
+                input_files,  # file name
+                [num < args.controls for num in range(len(input_files))],
+                weights=sizes, max_weight=max_size):
+            if err is Err.NO_ERROR:
+                samples.append(sample)
+                if tree is not None:
                     trees[sample] = tree
-                    taxids[sample] = out.get_taxlevels()
-                    counts[sample] = out.counts
-                    accs[sample] = out.accs
-                    scores[sample] = out.scores
-                    stats[sample] = stat
-                elif err is Err.VOID_CTRL:
-                    print('There were void controls.', red('Aborting!'))
-                    exit(1)
+                taxids[sample] = out.get_taxlevels()
+                counts[sample] = out.counts
+                accs[sample] = out.accs
+                scores[sample] = out.scores
+                stats[sample] = stat
+            elif err is Err.VOID_CTRL:
+                print('There were void controls.', red('Aborting!'))
+                exit(1)
         raw_samples.extend(samples)  # Store raw sample names
+        if executor.pool is not None:
+            print(gray('Parallel efficiency reading samples:'),
+                  f'{executor.efficiency:.1%}')
 
     def analyze_samples():
-        """Cross analysis of samples in parallel by taxlevel"""
+        """Cross analysis of samples in parallel by taxlevel and sample"""
         print(gray('Please, wait. Performing cross analysis in parallel...\n'))
-        # Update kwargs with more parameters for the followings func calls
-        kwargs.update({'taxids': taxids, 'counts': counts, 'scores': scores,
-                       'accs': accs, 'raw_samples': raw_samples})
-        if platform.system() and not args.sequential:  # Only for known systems
-            mpctx = mp.get_context('fork')  # Important for OSX&Win
-            with mpctx.Pool(processes=min(os.cpu_count(), len(
-                    Rank.selected_ranks))) as pool:
-                async_results = [pool.apply_async(
-                    process_rank,
-                    args=[level],
-                    kwds=kwargs
-                ) for level in Rank.selected_ranks]
-                for level, (smpls, abunds, accumulators, score) in zip(
-                        Rank.selected_ranks,
-                        [r.get() for r in async_results]):
-                    samples.extend(smpls)
-                    counts.update(abunds)
-                    accs.update(accumulators)
-                    scores.update(score)
-        else:  # sequential processing of each selected rank
-            for level in Rank.selected_ranks:
-                (smpls, abunds,
-                 accumulators, score) = process_rank(level, **kwargs)
-                samples.extend(smpls)
-                counts.update(abunds)
-                accs.update(accumulators)
-                scores.update(score)
+        # Share the samples data copy-on-write for the followings func calls
+        executor.refork(taxids=taxids, counts=counts, scores=scores,
+                        accs=accs, raw_samples=raw_samples)
+        smpls, abunds, accumulators, score, index = process_ranks(
+            executor, Rank.selected_ranks)
+        derived.update(index)
+        samples.extend(smpls)
+        counts.update(abunds)
+        accs.update(accumulators)
+        scores.update(score)
 
     def summarize_samples():
         """Summary of samples in parallel by type of cross-analysis"""
         # timing initialization
         summ_start_time: float = time.perf_counter()
         print(gray('Please, wait. Generating summaries in parallel...'))
-        # Update kwargs with more parameters for the followings func calls
-        kwargs.update({'samples': samples})
-        # Get list of set of samples to summarize (note pylint bug #776)
-        # pylint: disable=unsubscriptable-object
-        target_analysis: col.OrderedDict[str, None] = col.OrderedDict({
-            f'{raw}_{study}': None for study in [STR_EXCLUSIVE, STR_CONTROL]
-            for raw in raw_samples
-            for smpl in samples if smpl.startswith(f'{raw}_{study}')
-        })
-        # pylint: enable=unsubscriptable-object
+        # Share the updated data copy-on-write for the followings func calls
+        executor.refork(counts=counts, accs=accs, scores=scores)
+        # Get list of analysis to summarize from the index of samples
+        target_analysis: List[str] = [
+            f'{raw}_{study}' for study in [STR_EXCLUSIVE, STR_CONTROL]
+            for raw in raw_samples if f'{raw}_{study}' in derived]
         # Add shared and control_shared analysis if they exist (are not void)
-        for study in [STR_SHARED, STR_CONTROL_SHARED]:
-            for smpl in samples:
-                if smpl.startswith(study):
-                    target_analysis[study] = None
-                    break
-
-        if platform.system() and not args.sequential:  # Only for known systems
-            mpctx = mp.get_context('fork')
-            with mpctx.Pool(processes=min(os.cpu_count(),
-                                          len(input_files))) as pool:
-                async_results = [pool.apply_async(
-                    summarize_analysis,
-                    args=[analysis],
-                    kwds=kwargs
-                ) for analysis in target_analysis]
-                for analysis, (summary, abund, acc, score) in zip(
-                        target_analysis, [r.get() for r in async_results]):
-                    if summary:  # Avoid adding empty samples
-                        summaries.append(summary)
-                        counts[summary] = abund
-                        accs[summary] = acc
-                        scores[summary] = score
-        else:  # sequential processing of each selected rank
-            for analysis in target_analysis:
-                (summary, abund,
-                 acc, score) = summarize_analysis(analysis, **kwargs)
-                if summary:  # Avoid adding empty samples
-                    summaries.append(summary)
-                    counts[summary] = abund
-                    accs[summary] = acc
-                    scores[summary] = score
+        target_analysis.extend(study
+                               for study in [STR_SHARED, STR_CONTROL_SHARED]
+                               if study in derived)
+        for summary, abund, acc, score in executor.map(
+                summarize_analysis, target_analysis,
+                [list(derived[analysis].values())
+                 for analysis in target_analysis]):
+            if summary:  # Avoid adding empty samples
+                summaries.append(summary)
+                counts[summary] = abund
+                accs[summary] = acc
+                scores[summary] = score
         # Timing results
         print(gray('Summary elapsed time:'),
               f'{time.perf_counter() - summ_start_time:.3g}', gray('sec'))
 
-    def generate_krona():
-        """Generate Krona plot with all the results via Krona 2.0 XML spec"""
+    def prepare_krona() -> Tuple[Output, Filename]:
+        """Prepare Krona plot with all the results via Krona 2.0 XML spec"""
 
         print(gray('\nBuilding the taxonomy multiple tree... '), end='')
         sys.stdout.flush()
@@ -454,80 +455,96 @@ def main():
                                               for sample in samples
                                               if len(scores[sample])])),
                                      scoring=scoring,
+                                     compact=args.compact,
+                                     lazy=args.lazy,
+                                     tmpdir=executor.path,
                                      )
         polytree.grow(taxonomy=ncbi,
                       abundances=counts,
                       accs=accs,
                       scores=scores)
         print(green('OK!'))
-        print(gray('Generating final plot (') + magenta(htmlfile) +
-              gray(')... '), end='')
-        sys.stdout.flush()
-        polytree.toxml(taxonomy=ncbi, krona=krona)
-        krona.tohtml(htmlfile, pretty=False)
-        print(green('OK!'))
-
-    def generate_excel():
-        """Generate Excel with results via pandas DataFrame"""
+        branch_files: Dict[TaxId, Filename] = {}
+        # Write the branches of the tree in parallel (but lazy datasets
+        #   need the nodes written in order by the same KronaTree)
+        if executor.processes and not args.lazy:
+            print(gray('Generating the branches of the plot... '), end='')
+            sys.stdout.flush()
+            paths, sizes, branches = polytree.split(
+                BRANCHES_PER_PROCESS * executor.processes)
+            tids: List[TaxId] = [path[-1] for path in paths]
+            filenames: List[Filename] = [
+                Filename(os.path.join(executor.path, f'branch{num}.krona'))
+                for num in range(len(paths))]
+            executor.share(krona=krona)  # Every branch goes to one worker
+            executor.map(krona_branch, tids, branches, filenames,
+                         ['html'] * len(paths), weights=sizes)
+            branch_files = dict(zip(tids, filenames))
+            print(green('OK!'))
+        return KronaOutput(krona, htmlfile, branch_files), htmlfile
+
+    def prepare_excel() -> Tuple[Output, Filename]:
+        """Prepare Excel with results, written row by row via XlsxWriter"""
 
         xlsx_name: Filename = Filename(htmlfile.split('.html')[0] + '.xlsx')
-        print(gray(f'Generating Excel {str(excel).lower()} summary (') +
-              magenta(xlsx_name) + gray(')... '), end='')
-        sys.stdout.flush()
-        xlsxwriter = pd.ExcelWriter(xlsx_name)
-        list_rows: List = []
+        workbook = xlsxwriter.Workbook(xlsx_name, WORKBOOK_OPTIONS)
 
         # Save raw samples basic statistics
-        data_frame: pd.DataFrame = pd.DataFrame.from_dict(
-            {raw: stats[raw].to_dict() for raw in raw_samples})
-        data_frame.to_excel(xlsxwriter, sheet_name='_sample_stats')
+        write_stats(workbook, '_sample_stats', raw_samples, stats)
 
         # Save taxid related statistics per sample
         if excel is Excel.FULL:
-            polytree.to_items(taxonomy=ncbi, items=list_rows)
-            # Generate the pandas DataFrame from items and export to Excel
-            iterable_1 = [samples, [COUNT, UNASSIGNED, SCORE]]
-            cols1 = pd.MultiIndex.from_product(iterable_1,
-                                               names=['Samples', 'Stats'])
-            iterable_2 = [['Details'], ['Rank', 'Name']]
-            cols2 = pd.MultiIndex.from_product(iterable_2)
-            cols = cols1.append(cols2)
-            data_frame = pd.DataFrame.from_items(list_rows,
-                                                 orient='index',
-                                                 columns=cols)
-            data_frame.index.names = ['TaxId']
-            data_frame.to_excel(xlsxwriter, sheet_name=str(excel))
+            return FullExcel(workbook, str(excel), samples), xlsx_name
         elif excel is Excel.CMPLXCRUNCHER:
-            target_ranks: List = [Rank.NO_RANK]
+            sheets: List[Tuple[str, List[str], List[int]]] = []
             if args.controls:
-                target_ranks = [Rank.SPECIES, Rank.GENUS,  # Ranks of interest
-                                Rank.FAMILY, Rank.ORDER]  # for cmplxcruncher
-            for rank in target_ranks:  # Once for no rank dependency (NO_RANK)
-                indexes: List[int]
-                sheet_name: str
-                columns: List[str]
-                if args.controls:
-                    indexes = [i for i in range(len(raw_samples), len(samples))
-                               if (samples[i].startswith(STR_CONTROL)
-                                   and rank.name.lower() in samples[i])]
-                    sheet_name = f'{STR_CONTROL}_{rank.name.lower()}'
-                    columns = [samples[i].split('_')[2] for i in indexes]
-                else:  # No rank dependency
-                    indexes = list(range(len(raw_samples)))
-                    sheet_name = f'raw_samples_{rank.name.lower()}'
-                    columns = [samples[i].split('_')[0] for i in indexes]
-                list_rows = []
-                polytree.to_items(taxonomy=ncbi, items=list_rows,
-                                  sample_indexes=indexes)
-                data_frame = pd.DataFrame.from_items(list_rows,
-                                                     orient='index',
-                                                     columns=columns)
-                data_frame.index.names = ['TaxId']
-                data_frame.to_excel(xlsxwriter, sheet_name=sheet_name)
+                for rank in [Rank.SPECIES, Rank.GENUS,  # Ranks of interest
+                             Rank.FAMILY, Rank.ORDER]:  # for cmplxcruncher
+                    indexes: List[int] = [
+                        i for i in range(len(raw_samples), len(samples))
+                        if (samples[i].startswith(STR_CONTROL)
+                            and rank.name.lower() in samples[i])]
+                    sheets.append((f'{STR_CONTROL}_{rank.name.lower()}',
+                                   [samples[i].split('_')[2] for i in indexes],
+                                   indexes))
+            else:  # Once for no rank dependency (NO_RANK)
+                sheets.append((f'raw_samples_{Rank.NO_RANK.name.lower()}',
+                               [raw.split('_')[0] for raw in raw_samples],
+                               list(range(len(raw_samples)))))
+            return CountsExcel(workbook, sheets), xlsx_name
         else:
             raise Exception(red('\nERROR!'),
                             f'Unknown Excel option "{excel}"')
-        xlsxwriter.save()
+
+    def prepare_table(table: Table) -> Tuple[Output, Filename]:
+        """Prepare a table with the full results in other format"""
+
+        table_name: Filename = Filename(htmlfile.split('.html')[0] + '.'
+                                        + str(table).lower())
+        if table is Table.TSV:
+            return TsvTable(table_name, samples), table_name
+        elif table is Table.NPZ:
+            return NpzTable(table_name, polytree), table_name
+        else:
+            raise Exception(red('\nERROR!'),
+                            f'Unknown table option "{table}"')
+
+    def generate_outputs():
+        """Generate all the final outputs with a single walk of the tree"""
+
+        final_outputs: List[Tuple[Output, Filename]] = [prepare_krona()]
+        if _USE_XLSXWRITER:
+            final_outputs.append(prepare_excel())
+        else:
+            print(yellow('WARNING!'),
+                  'XlsxWriter not installed: Excel cannot be created.')
+        final_outputs.extend(prepare_table(table) for table in tables)
+        print(gray('Generating final outputs (') +
+              magenta(', '.join(name for _, name in final_outputs)) +
+              gray(')... '), end='')
+        sys.stdout.flush()
+        polytree.walk(taxonomy=ncbi,
+                      outputs=[output for output, _ in final_outputs])
         print(green('OK!'))
 
     # timing initialization
@@ -551,12 +568,13 @@ def main():
     including: Set[TaxId] = set(args.include)
     scoring: Scoring = Scoring[args.scoring]
     excel: Excel = Excel[args.excel]
+    tables: List[Table] = [Table[table] for table in args.table]
 
     check_debug()
 
     plasmidfile: Filename = None
-    process: Callable[..., Tuple[Sample, TaxTree, SampleDataByTaxId,
-                                 SampleStats, Err]]
+    process: Callable[..., Tuple[Sample, Optional[TaxTree],
+                                 SampleDataByTaxId, SampleStats, Err]]
     select_inputs()
     check_controls()
     if not htmlfile:
@@ -572,7 +590,7 @@ def main():
         exit(0)
 
     # Declare variables that will hold results for the samples analyzed
-    trees: Dict[Sample, TaxTree] = {}
+    trees: Dict[Sample, TaxTree] = {}  # Only populated with --keeptrees
     counts: Dict[Sample, Counter[TaxId]] = {}
     accs: Dict[Sample, Counter[TaxId]] = {}
     taxids: Dict[Sample, TaxLevels] = {}
@@ -580,6 +598,7 @@ def main():
     stats: Dict[Sample, SampleStats] = {}
     samples: List[Sample] = []
     raw_samples: List[Sample] = []
+    derived: Dict[str, Dict[Rank, Sample]] = {}  # Index of derived samples
 
     # Define dictionary of parameters for methods to be called (to be extended)
     kwargs = {'controls': args.controls,
@@ -589,31 +608,30 @@ def main():
               'ctrlmintaxa': (
                   args.ctrlmintaxa
                   if args.ctrlmintaxa is not None else args.mintaxa),
-              'debug': args.debug, 'root': args.takeoutroot,
+              'debug': args.debug, 'keeptrees': args.keeptrees,
+              'root': args.takeoutroot,
               'lmat': bool(lmats), 'minscore': args.minscore,
               'mintaxa': args.mintaxa, 'scoring': scoring, 'taxonomy': ncbi,
               }
-    # The big stuff (done in parallel)
-    read_samples()
-    # Avoid cross analysis if just one report file or explicitly stated by flag
-    if len(raw_samples) > 1 and not args.avoidcross:
-        analyze_samples()
-        if args.summary != 'avoid':
-            summaries: List[Sample] = []
-            summarize_samples()
-            if args.summary == 'only':
-                samples = raw_samples + summaries
-            else:
-                samples.extend(summaries)
-    # Final result generation is done in sequential mode
-
-    polytree: MultiTree = MultiTree(samples=samples)
-    generate_krona()
-    if _USE_PANDAS:
-        generate_excel()
-    else:
-        print(yellow('WARNING!'),
-              'Pandas not installed: Excel cannot be created.')
+    # The big stuff (done in parallel by the same workers for all the stages)
+    processes: int = 0  # Sequential processing
+    if platform.system() and not args.sequential:  # Only for known systems
+        processes = min(os.cpu_count(), max_tasks())
+    with Executor(kwargs, processes) as executor:
+        read_samples()
+        # Avoid cross analysis if just one report file or explicitly stated
+        if len(raw_samples) > 1 and not args.avoidcross:
+            analyze_samples()
+            if args.summary != 'avoid':
+                summaries: List[Sample] = []
+                summarize_samples()
+                if args.summary == 'only':
+                    samples = raw_samples + summaries
+                else:
+                    samples.extend(summaries)
+        polytree: MultiTree = MultiTree(samples=samples)
+        # Final results generated in sequential mode (after the branches)
+        generate_outputs()
 
     # Timing results
     print(gray('Total elapsed time:'), time.strftime(
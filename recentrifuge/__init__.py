@@ -13,7 +13,7 @@ from . import centrifuge_io  # Centrifuge support
 from . import fastq_io  # Quick FASTQ support
 
 __all__ = ['config', 'shared_counter', 'taxonomy', 'trees', 'rank',
-           'core', 'centrifuge', 'lmat', 'krona']
+           'core', 'centrifuge', 'lmat', 'krona', 'parallel']
 __author__ = 'Jose Manuel Marti'
 
 # python
@@ -19,7 +19,7 @@ from recentrifuge.config import NO_SCORE, Err, SampleStats
 from recentrifuge.config import UNCLASSIFIED, ROOT, CELLULAR_ORGANISMS
 from recentrifuge.config import gray, red, green, yellow, blue
 from recentrifuge.lmat import read_lmat_output
-from recentrifuge.rank import Rank, Ranks
+from recentrifuge.rank import Rank
 from recentrifuge.taxonomy import Taxonomy
 from recentrifuge.trees import TaxTree, SampleDataByTaxId
 
@@ -56,10 +56,13 @@ def read_report(report_file: str) -> Tuple[str, Counter[TaxId],
 
 
 def process_report(*args, **kwargs
-                   ) -> Tuple[Sample, TaxTree, SampleDataByTaxId,
+                   ) -> Tuple[Sample, Optional[TaxTree], SampleDataByTaxId,
                               SampleStats, Err]:
     """
     Process Centrifuge/Kraken report files (to be usually called in parallel!).
+
+    The taxonomy tree of the sample is returned only if the 'keeptrees'
+    keyword argument is set; otherwise None is returned in its place.
     """
     # TODO: Full review to report support
     # Recover input and parameters
@@ -69,7 +72,6 @@ def process_report(*args, **kwargs
     collapse: bool = taxonomy.collapse
     including: Set[TaxId] = taxonomy.including
     excluding: Set[TaxId] = taxonomy.excluding
-    debug: bool = kwargs['debug']
     output: io.StringIO = io.StringIO(newline='')
 
     def vwrite(*args):
@@ -90,43 +92,32 @@ def process_report(*args, **kwargs
         abundances[ROOT] = 0
         vwrite(green('OK!'), '\n')
 
-    # Build taxonomy tree
-    output.write('  \033[90mBuilding taxonomy tree...\033[0m')
+    # Build, prune and shape the taxonomy tree, getting the taxa with their
+    #   abundances and taxonomical levels
+    output.write('  \033[90mBuilding and pruning taxonomy tree...\033[0m')
     tree = TaxTree()
-    tree.grow(taxonomy=taxonomy,
-              counts=abundances)  # Grow tax tree from root node
-    output.write('\033[92m OK! \033[0m\n')
-
-    # Prune the tree
-    output.write('  \033[90mPruning taxonomy tree...\033[0m')
-    tree.prune(mintaxa, None, collapse, debug)
-    tree.shape()
-    output.write('\033[92m OK! \033[0m\n')
-
-    # Get the taxa with their abundances and taxonomical levels
-    output.write('  \033[90mFiltering taxa...\033[0m')
-    new_abund: Counter[TaxId] = col.Counter()
-    new_accs: Counter[TaxId] = col.Counter()
-    ranks: Ranks = Ranks({})
-    tree.get_taxa(abundance=new_abund,
-                  accs=new_accs,
-                  ranks=ranks,
-                  mindepth=0, maxdepth=0,
-                  include=including,
-                  exclude=excluding)
-    new_abund = +new_abund  # remove zero and negative counts
+    out: SampleDataByTaxId = SampleDataByTaxId(['counts', 'ranks', 'accs'])
+    tree.grow_prune_shape(taxonomy=taxonomy,
+                          counts=abundances,
+                          min_taxa=mintaxa,
+                          collapse=collapse,
+                          include=including,
+                          exclude=excluding,
+                          out=out)
+    new_abund: Counter[TaxId] = +out.get_counts()  # remove zero/neg counts
     if including or excluding:  # Recalculate accumulated counts
         new_tree = TaxTree()
-        new_tree.grow(taxonomy, new_abund)  # Grow tree with new abund
-        new_tree.shape()
-        new_abund = col.Counter()  # Reset abundances
-        new_accs = col.Counter()  # Reset accumulated
-        new_tree.get_taxa(new_abund, new_accs)  # Get new accumulated counts
-    out: SampleDataByTaxId = SampleDataByTaxId()
-    out.set(counts=new_abund, ranks=ranks, accs=new_accs)
+        new_out = SampleDataByTaxId(['counts', 'accs'])
+        new_tree.grow_prune_shape(taxonomy, new_abund, min_taxa=0,
+                                  out=new_out)  # Grow tree with new abund
+        out.set(counts=new_out.counts, accs=new_out.accs)
+    else:
+        out.set(counts=new_abund)
     output.write('\033[92m OK! \033[0m\n')
     print(output.getvalue())
     sys.stdout.flush()
+    if not kwargs.get('keeptrees'):
+        tree = None  # Avoid pickling the tree back to the parent process
     return sample, tree, out, SampleStats(), Err.NO_ERROR
 
 
@@ -247,10 +238,13 @@ def read_output(output_file: Filename,
 
 
 def process_output(*args, **kwargs
-                   ) -> Tuple[Sample, TaxTree, SampleDataByTaxId,
+                   ) -> Tuple[Sample, Optional[TaxTree], SampleDataByTaxId,
                               SampleStats, Err]:
     """
     Process Centrifuge/LMAT output files (to be usually called in parallel!).
+
+    The taxonomy tree of the sample is returned only if the 'keeptrees'
+    keyword argument is set; otherwise None is returned in its place.
     """
     # timing initialization
     start_time: float = time.perf_counter()
@@ -379,6 +373,8 @@ def process_output(*args, **kwargs
                  f'{time.perf_counter() - start_time:.3g}' + gray(' sec\n'))
     print(output.getvalue())
     sys.stdout.flush()
+    if not kwargs.get('keeptrees'):
+        tree = None  # Avoid pickling the tree back to the parent process
     return sample, tree, out, stat, error
 
 
@@ -47,6 +47,13 @@ ROBUST_XOVER_OUTLIER = 5  # Cutoff for crossover outlier test, typ in [2, 3]
 ROBUST_XOVER_ORD_MAG = 3  # Relfreq order of magnitude dif in crossover test
 SEVR_CONTM_MIN_RELFREQ: float = 0.01  # Min rel frequency of severe contaminant
 MILD_CONTM_MIN_RELFREQ: float = 0.001  # Min rel frequency of mild contaminant
+QN_BATCH_MAX_COLS: int = 128  # Max num of samples to get Qn with all difs
+QN_BATCH_MAX_DIFS: int = 2**22  # Max num of pairwise difs in a Qn batch
+MEM_PER_INPUT_BYTE: float = 2.0  # Estimated memory to read a byte of sample
+BRANCHES_PER_PROCESS: int = 4  # Branches of the Krona tree for each worker
+OUTPUT_BATCH_NODES: int = 512  # Nodes sent at once to an output thread
+OUTPUT_QUEUE_BATCHES: int = 8  # Max batches waiting for an output thread
+LAZY_BUFFER_VALUES: int = 2**16  # Max values of lazy chunks kept in memory
 
 
 class Scoring(Enum):
@@ -70,6 +77,15 @@ class Excel(Enum):
         return f'{str(self.name)}'
 
 
+class Table(Enum):
+    """Enumeration with table output options (besides excel)."""
+    TSV = 0  # Tab separated values, written in chunks of rows
+    NPZ = 1  # NumPy (uncompressed) archive with the data by columns
+
+    def __str__(self):
+        return f'{str(self.name)}'
+
+
 class Err(Enum):
     """Enumeration with error codes"""
     NO_ERROR = 0  # No error
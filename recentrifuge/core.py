@@ -4,12 +4,15 @@ Recentrifuge core functions.
 """
 import csv
 import io
-import statistics
 import subprocess
 import sys
+from enum import Enum
 from typing import List, Set, Counter, Tuple, Union, Dict
 
-from recentrifuge.config import ROBUST_MIN_SAMPLES
+import numpy as np
+
+from recentrifuge.config import ROBUST_MIN_SAMPLES, QN_BATCH_MAX_COLS
+from recentrifuge.config import QN_BATCH_MAX_DIFS
 from recentrifuge.config import ROBUST_XOVER_ORD_MAG, ROBUST_XOVER_OUTLIER
 from recentrifuge.config import Filename, Sample, TaxId, Parents, Score, Scores
 from recentrifuge.config import HTML_SUFFIX, CELLULAR_ORGANISMS, ROOT, EPS
@@ -18,33 +21,253 @@ from recentrifuge.config import STR_CONTROL, STR_EXCLUSIVE, STR_SHARED
 from recentrifuge.config import STR_SUMMARY, STR_CONTROL_SHARED
 from recentrifuge.config import UnionCounter, UnionScores
 from recentrifuge.config import gray, red, yellow, blue, magenta, cyan, green
+from recentrifuge.parallel import Executor
 from recentrifuge.rank import Rank, TaxLevels
 from recentrifuge.shared_counter import SharedCounter
 from recentrifuge.taxonomy import Taxonomy
-from recentrifuge.trees import TaxTree, SampleDataByTaxId
+from recentrifuge.trees import TaxTree, FlatTree, MultiTree, SampleDataByTaxId
+
+
+class Contamination(Enum):
+    """Enumeration with the classes of control taxa (contaminants)."""
+    JUST_CTRL = 0  # Present just in the controls
+    CRITICAL = 1  # Over severe threshold in all the controls
+    SEVERE = 2  # Over severe threshold in any control
+    MILD = 3  # Over mild threshold in all the controls
+    CROSSOVER = 4  # Outlier in some samples (crossover source)
+    OTHER = 5  # Other contamination
+
+
+def qn_constant(dist: str) -> float:
+    """Get the d parameter of Qn depending on the distribution"""
+    c_d: float
+    if dist == "Gauss":
+        c_d = 2.2219
+    elif dist == "Cauchy":  # Heavy-tailed distribution
+        c_d = 1.2071
+    elif dist == "NegExp":  # Negative exponential (asymetric)
+        c_d = 3.4760
+    else:
+        raise Exception(red('\nERROR! ') + 'Unknown distribution')
+    return c_d
 
 
-def process_rank(*args,
-                 **kwargs
-                 ) -> Tuple[List[Sample],
-                            Dict[Sample, UnionCounter],
-                            Dict[Sample, Counter[TaxId]],
-                            Dict[Sample, UnionScores]]:
+def compute_qn(data: List[float], dist: str = "Gauss") -> float:
+    """Compute Qn robust estimator of scale (Rousseeuw, 1993)"""
+    c_d: float = qn_constant(dist)
+    num: int = len(data)
+    k: int = int(num * (num / 2 + 1) / 4)
+    return c_d * select_pairwise_dif(sorted(data), k)
+
+
+def compute_qns(data: np.ndarray, dist: str = "Gauss") -> np.ndarray:
+    """
+    Compute Qn robust estimator of scale for each row of a matrix.
+
+    For a few columns, the pairwise differences of a chunk of rows are
+    generated at once and the k-th of each row is selected with a
+    partition; otherwise, compute_qn is called row by row.
+
+    Args:
+        data: Matrix with a set of values in each row.
+        dist: Distribution (to select the d parameter).
+
+    Returns: Array with the Qn of each row.
+
+    """
+    c_d: float = qn_constant(dist)
+    rows, num = data.shape
+    if num > QN_BATCH_MAX_COLS:
+        return np.array([compute_qn(row, dist) for row in data.tolist()],
+                        dtype=float)
+    k: int = int(num * (num / 2 + 1) / 4)
+    srt: np.ndarray = np.sort(data, axis=1)
+    first, second = np.triu_indices(num, 1)
+    chunk: int = max(1, QN_BATCH_MAX_DIFS // max(1, len(first)))
+    q_n: np.ndarray = np.empty(rows)
+    for start in range(0, rows, chunk):
+        difs: np.ndarray = (srt[start:start + chunk, second]
+                            - srt[start:start + chunk, first])
+        q_n[start:start + chunk] = c_d * np.partition(
+            difs, k - 1, axis=1)[:, k - 1]
+    return q_n
+
+
+def score_contaminants(relfreq: np.ndarray,
+                       controls: int,
+                       ) -> Tuple[np.ndarray, np.ndarray,
+                                  np.ndarray, np.ndarray]:
+    """
+    Classify the control taxa (candidate contaminants) all at once.
+
+    The checks of the robust contamination removal algorithm are
+    evaluated as operations over the matrix of relative frequencies,
+    in order of precedence, and the crossover test (with the median
+    and the Qn of the relative frequencies of the taxa) is just done
+    for the taxa not classified by the previous checks.
+
+    Args:
+        relfreq: Matrix (taxa x raw samples, controls first) with the
+            relative frequencies of the candidate taxa.
+        controls: Number of control samples.
+
+    Returns:
+        Array with the class (Contamination value) of each taxon,
+        arrays with the outlier and the order of magnitude limits of
+        the crossover test (NaN if not evaluated), and boolean matrix
+        (taxa x non-control samples) with the result of the test.
+
+    """
+    relfreq_ctrl: np.ndarray = relfreq[:, :controls]
+    relfreq_smpl: np.ndarray = relfreq[:, controls:]
+    classes: np.ndarray = np.full(len(relfreq), Contamination.OTHER.value)
+    pending: np.ndarray = np.ones(len(relfreq), dtype=bool)
+    for contamination, found in (
+            (Contamination.JUST_CTRL, (relfreq_smpl < EPS).all(axis=1)),
+            (Contamination.CRITICAL,
+             (relfreq_ctrl > SEVR_CONTM_MIN_RELFREQ).all(axis=1)),
+            (Contamination.SEVERE,
+             (relfreq_ctrl > SEVR_CONTM_MIN_RELFREQ).any(axis=1)),
+            (Contamination.MILD,
+             (relfreq_ctrl > MILD_CONTM_MIN_RELFREQ).all(axis=1))):
+        classes[pending & found] = contamination.value
+        pending &= ~found
+    # Calculate median and Qn but including controls
+    outlier_lim: np.ndarray = np.full(len(relfreq), np.nan)
+    ordomag_lim: np.ndarray = np.full(len(relfreq), np.nan)
+    crossover: np.ndarray = np.zeros(relfreq_smpl.shape, dtype=bool)
+    if pending.any():
+        mdn: np.ndarray = np.median(relfreq[pending], axis=1)
+        q_n: np.ndarray = compute_qns(relfreq[pending], dist="NegExp")
+        # Calculate crossover in samples
+        outlier_lim[pending] = mdn + ROBUST_XOVER_OUTLIER * q_n
+        ordomag_lim[pending] = (relfreq_ctrl[pending].max(axis=1)
+                                * 10**ROBUST_XOVER_ORD_MAG)
+        crossover[pending] = (
+            (relfreq_smpl[pending] > outlier_lim[pending, None])
+            & (relfreq_smpl[pending] > ordomag_lim[pending, None]))
+        classes[pending & crossover.any(axis=1)] = (
+            Contamination.CROSSOVER.value)
+    return classes, outlier_lim, ordomag_lim, crossover
+
+
+def select_pairwise_dif(data: List[float], k: int) -> float:
+    """
+    Select the k-th smallest of the pairwise differences of sorted data.
+
+    The differences data[i] - data[j] (with j < i) are seen as the
+    rows of a matrix, each one sorted. The candidates of each row are
+    narrowed around a trial value (the weighted median of the medians
+    of the rows) until there are no more than n of them, which are
+    then just sorted (Croux and Rousseeuw, 1992). This is done in
+    O(n log n) time without generating the n(n-1)/2 differences.
+
+    Args:
+        data: Sorted list of values.
+        k: Order (1-based) of the difference to select.
+
+    Returns: The k-th smallest pairwise difference.
+
+    """
+    srt: np.ndarray = np.array(data, dtype=float)
+    num: int = len(srt)
+    rows: np.ndarray = np.arange(num)  # Row i has i differences
+    left: np.ndarray = np.zeros(num, dtype=np.int64)  # Candidates bounds
+    right: np.ndarray = rows - 1  # (both inclusive) in ascending order
+
+    def row_counts(trial: float, strict: bool) -> np.ndarray:
+        """Count the differences of each row below (or not above) trial"""
+        # Bisect for the first j with data[i] - data[j] below the trial
+        low: np.ndarray = np.zeros(num, dtype=np.int64)
+        high: np.ndarray = rows.copy()
+        active: np.ndarray = low < high
+        while active.any():
+            mid: np.ndarray = (low + high) // 2
+            difs: np.ndarray = srt - srt[mid]
+            below: np.ndarray = difs < trial if strict else difs <= trial
+            high = np.where(active & below, mid, high)
+            low = np.where(active & ~below, mid + 1, low)
+            active = low < high
+        return rows - low
+
+    while (right - left + 1).sum() > num:
+        valid: np.ndarray = right >= left
+        mids: np.ndarray = (left[valid] + right[valid]) // 2
+        medians: np.ndarray = srt[rows[valid]] - srt[rows[valid] - 1 - mids]
+        order: np.ndarray = np.argsort(medians, kind='mergesort')
+        weights: np.ndarray = np.cumsum((right - left + 1)[valid][order])
+        trial: float = medians[order][np.searchsorted(weights,
+                                                      weights[-1] / 2)]
+        less: np.ndarray = row_counts(trial, strict=True)
+        less_equal: np.ndarray = row_counts(trial, strict=False)
+        if k <= less.sum():
+            right = less - 1
+        elif k > less_equal.sum():
+            left = less_equal
+        else:
+            return float(trial)
+    sizes: np.ndarray = np.maximum(right - left + 1, 0)
+    cand_rows: np.ndarray = np.repeat(rows, sizes)
+    cand_pos: np.ndarray = (np.arange(sizes.sum())
+                            - np.repeat(np.cumsum(sizes) - sizes, sizes)
+                            + np.repeat(left, sizes))
+    candidates: np.ndarray = np.sort(srt[cand_rows]
+                                     - srt[cand_rows - 1 - cand_pos])
+    return float(candidates[k - left.sum() - 1])
+
+
+def presence_bitmap(taxids: Dict[Sample, TaxLevels],
+                    raws: List[Sample],
+                    rank: Rank,
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the presence of the taxa of a rank in the other raw samples.
+
+    A boolean matrix (taxa x samples) with the presence of the taxa in
+    each sample is built, and the number of samples where each taxon
+    is present is used to derive, in one pass for all the samples,
+    whether a taxon is present in any sample but the one of a column.
+
+    Args:
+        taxids: Dict with the taxids of each rank for each sample.
+        raws: List of the raw samples (the order of the columns).
+        rank: Taxonomic rank.
+
+    Returns:
+        Array with the taxa present in any sample at the rank, and
+        boolean matrix (taxa x samples) flagging the taxa present in
+        some of the other samples.
+
     """
-    Process results for a taxlevel (to be usually called in parallel!).
+    taxa: List[TaxId] = list(set().union(
+        *(taxids[raw][rank] for raw in raws)))
+    index: Dict[TaxId, int] = {tid: i for i, tid in enumerate(taxa)}
+    presence: np.ndarray = np.zeros((len(taxa), len(raws)), dtype=bool)
+    for col, raw in enumerate(raws):
+        presence[[index[tid] for tid in taxids[raw][rank]], col] = True
+    in_samples: np.ndarray = presence.sum(axis=1, keepdims=True)
+    return np.array(taxa, dtype=object), in_samples > presence
+
+
+def control_exclusions(*args,
+                       **kwargs
+                       ) -> Tuple[str, Dict[Sample, Set[TaxId]], Set[TaxId]]:
     """
+    Get the control taxa to exclude from the samples for a taxlevel.
 
+    Returns:
+        Log string, dict with the set of taxa to exclude for each
+        (non control) sample, and set with all the candidate taxa to
+        exclude (used for the control-shared analysis).
+
+    """
     # Recover input and parameters
     rank: Rank = args[0]
     controls: int = kwargs['controls']
-    mintaxa = kwargs['mintaxa']
     taxonomy: Taxonomy = kwargs['taxonomy']
-    including = taxonomy.including
     excluding = taxonomy.excluding
     taxids: Dict[Sample, TaxLevels] = kwargs['taxids']
-    counts: Dict[Sample, UnionCounter] = kwargs['counts']
     accs: Dict[Sample, Counter[TaxId]] = kwargs['accs']
-    scores: Dict[Sample, UnionScores] = kwargs['scores']
     raws: List[Sample] = kwargs['raw_samples']
     output: io.StringIO = io.StringIO(newline='')
 
@@ -62,101 +285,286 @@ def process_rank(*args,
         return ('[' + (', '.join(magenta('T') if elm else 'F' for elm in lst))
                 + ']')
 
-    # Declare/define variables
-    samples: List[Sample] = []
-    # pylint: disable = unused-variable
-    shared_counts: SharedCounter = SharedCounter()
-    shared_score: SharedCounter = SharedCounter()
-    shared_ctrl_counts: SharedCounter = SharedCounter()
-    shared_ctrl_score: SharedCounter = SharedCounter()
-    # pylint: enable = unused-variable
-
-    output.write(f'\033[90mAnalysis for taxonomic rank "'
-                 f'\033[95m{rank.name.lower()}\033[90m":\033[0m\n')
-
-    def cross_analysis(iteration, raw):
-        """Cross analysis: exclusive and part of shared&ctrl"""
-        nonlocal shared_counts, shared_score
-        nonlocal shared_ctrl_counts, shared_ctrl_score
-
-        def partial_shared_update(i):
-            """Perform shared and shared-control taxa partial evaluations"""
-            nonlocal shared_counts, shared_score
-            nonlocal shared_ctrl_counts, shared_ctrl_score
-            if i == 0:  # 1st iteration: Initialize shared abundance and score
-                shared_counts.update(sub_shared_counts)
-                shared_score.update(sub_shared_score)
-            elif i < controls:  # Just update shared abundance and score
-                shared_counts &= sub_shared_counts
-                shared_score &= sub_shared_score
-            elif i == controls:  # Initialize shared-control counters
-                shared_counts &= sub_shared_counts
-                shared_score &= sub_shared_score
-                shared_ctrl_counts.update(sub_shared_counts)
-                shared_ctrl_score.update(sub_shared_score)
-            elif controls:  # Both: Accumulate shared abundance and score
-                shared_counts &= sub_shared_counts
-                shared_score &= sub_shared_score
-                shared_ctrl_counts &= sub_shared_counts
-                shared_ctrl_score &= sub_shared_score
-            else:  # Both: Accumulate shared abundance and score (no controls)
-                shared_counts &= sub_shared_counts
-                shared_score &= sub_shared_score
-
-        exclude: Set[TaxId] = set()
-        # Get taxids at this rank that are present in the other samples
-        for sample in (smpl for smpl in raws if smpl != raw):
-            exclude.update(taxids[sample][rank])
-        exclude.update(excluding)  # Add explicit excluding taxa if any
-        output.write(f'  \033[90mExclusive: From \033[0m{raw}\033[90m '
-                     f'excluding {len(exclude)} taxa. '
-                     f'Generating sample...\033[0m')
-
-        exclude_tree = TaxTree()
-        exclude_out = SampleDataByTaxId(['counts', 'scores', 'accs'])
-        exclude_tree.allin1(taxonomy=taxonomy,
-                            counts=counts[raw],
-                            scores=scores[raw],
-                            min_taxa=mintaxa,
-                            min_rank=rank,
-                            just_min_rank=True,
-                            include=including,
-                            exclude=exclude,
-                            out=exclude_out)
-        exclude_out.purge_counters()
-        if exclude_out.counts:  # Avoid adding empty samples
-            sample = Sample(f'{raw}_{STR_EXCLUSIVE}_{rank.name.lower()}')
-            samples.append(sample)
-            counts[sample] = exclude_out.get_counts()
-            accs[sample] = exclude_out.get_accs()
-            scores[sample] = exclude_out.get_scores()
-            output.write('\033[92m OK! \033[0m\n')
+    def robust_contamination_removal():
+        """Implement robust contamination removal algorithm."""
+        nonlocal exclude_sets
+
+        vwrite(gray('Robust contamination removal: '
+                    'Searching for contaminants...\n'))
+        candidates: np.ndarray = np.array(list(exclude_candidates),
+                                          dtype=object)
+        relfreq: np.ndarray = np.array(
+            [[accs[raw][tid] for raw in raws] for tid in candidates],
+            dtype=float).reshape(len(candidates), len(raws))
+        relfreq /= [accs[raw][ROOT] for raw in raws]
+        classes, outlier_lim, ordomag_lim, crossover = score_contaminants(
+            relfreq, controls)
+        excluded: np.ndarray = (
+            (classes != Contamination.JUST_CTRL.value)[:, None]
+            & ~((classes == Contamination.CROSSOVER.value)[:, None]
+                & crossover))
+        exclude_sets = {smpl: set(candidates[excluded[:, i]])
+                        for i, smpl in enumerate(raws[controls:])}
+        if not kwargs['debug']:
+            return
+        for num, tid in enumerate(candidates):
+            relfreq_ctrl: List[float] = relfreq[num, :controls].tolist()
+            relfreq_smpl: List[float] = relfreq[num, controls:].tolist()
+            contamination: Contamination = Contamination(classes[num])
+            if contamination is Contamination.JUST_CTRL:
+                vwrite(cyan('just-ctrl:\t'), tid, taxonomy.get_name(tid),
+                       gray('relfreq:'), fltlst2str(relfreq_ctrl) +
+                       fltlst2str(relfreq_smpl), '\n')
+            elif contamination is Contamination.CRITICAL:
+                vwrite(red('critical:\t'), tid, taxonomy.get_name(tid),
+                       gray('relfreq:'), fltlst2str(relfreq_ctrl) +
+                       fltlst2str(relfreq_smpl), '\n')
+            elif contamination is Contamination.SEVERE:
+                vwrite(yellow('severe: \t'), tid, taxonomy.get_name(tid),
+                       gray('relfreq:'), fltlst2str(relfreq_ctrl) +
+                       fltlst2str(relfreq_smpl), '\n')
+            elif contamination is Contamination.MILD:
+                vwrite(blue('mild cont:\t'), tid, taxonomy.get_name(tid),
+                       gray('relfreq:'), fltlst2str(relfreq_ctrl) +
+                       fltlst2str(relfreq_smpl), '\n')
+            elif contamination is Contamination.CROSSOVER:
+                vwrite(magenta('crossover:\t'), tid,
+                       taxonomy.get_name(tid), green(
+                        f'lims: [{outlier_lim[num]:.1g}]' + (
+                            '<' if outlier_lim[num] < ordomag_lim[num]
+                            else '>') + f'[{ordomag_lim[num]:.1g}]'),
+                       gray('relfreq:'), fltlst2str(relfreq_ctrl) +
+                       fltlst2str(relfreq_smpl),
+                       gray('crossover:'), blst2str(crossover[num]), '\n')
+                # Exclude just for contaminated samples (not the source)
+                vwrite(magenta('\t->'), gray(f'Include {tid} just in:'))
+                for i in range(len(raws[controls:])):
+                    if crossover[num, i]:
+                        vwrite(f' {raws[i + controls]}')
+                vwrite('\n')
+            else:  # Other contamination: remove from all samples
+                vwrite(gray('other cont:\t'), tid, taxonomy.get_name(tid),
+                       green(f'lims: [{outlier_lim[num]:.1g}]' + (
+                           '<' if outlier_lim[num] < ordomag_lim[num]
+                           else '>') + f'[{ordomag_lim[num]:.1g}]'),
+                       gray('relfreq:'), fltlst2str(relfreq_ctrl) +
+                       fltlst2str(relfreq_smpl), '\n')
+
+    # Get taxids at this rank that are present in the control samples
+    exclude_candidates: Set[TaxId] = set()
+    for i in range(controls):
+        exclude_candidates.update(taxids[raws[i]][rank])
+    exclude_sets: Dict[Sample, Set[TaxId]]
+    if controls and (len(raws) - controls >= ROBUST_MIN_SAMPLES):
+        robust_contamination_removal()
+    else:  # If this case, just apply strict control
+        exclude_sets = {file: exclude_candidates
+                        for file in raws[controls::]}
+    # Add explicit excluding taxa (if any) to exclude sets
+    for exclude_set in exclude_sets.values():
+        exclude_set.update(excluding)
+    exclude_candidates.update(excluding)
+    return output.getvalue(), exclude_sets, exclude_candidates
+
+
+def cross_analysis(*args,
+                   **kwargs
+                   ) -> Tuple[str, SampleDataByTaxId, SampleDataByTaxId,
+                              str, SampleDataByTaxId]:
+    """
+    Cross analysis of a sample for a taxlevel (usually called in parallel!).
+
+    The exclusive, the control (if the taxa to exclude is given) and
+    the partial shared analysis (to be reduced for all the samples by
+    shared_analysis) are performed for the sample.
+
+    Returns:
+        Log string of the exclusive analysis, exclusive sample data
+        (None if void), partial shared data, log string of the control
+        analysis and control sample data (None if void or not done).
+
+    """
+    # Recover input and parameters
+    rank: Rank = args[0]
+    raw: Sample = args[1]
+    ctrl_exclude: Set[TaxId] = args[2]
+    mintaxa = kwargs['mintaxa']
+    taxonomy: Taxonomy = kwargs['taxonomy']
+    including = taxonomy.including
+    excluding = taxonomy.excluding
+    counts: Dict[Sample, UnionCounter] = kwargs['counts']
+    scores: Dict[Sample, UnionScores] = kwargs['scores']
+    raws: List[Sample] = kwargs['raw_samples']
+    output: io.StringIO = io.StringIO(newline='')
+    ctrl_output: io.StringIO = io.StringIO(newline='')
+
+    # Get taxids at this rank that are present in the other samples
+    taxa, in_others = kwargs['presence'][rank]
+    exclude: Set[TaxId] = set(taxa[in_others[:, raws.index(raw)]])
+    exclude.update(excluding)  # Add explicit excluding taxa if any
+    output.write(f'  \033[90mExclusive: From \033[0m{raw}\033[90m '
+                 f'excluding {len(exclude)} taxa. '
+                 f'Generating sample...\033[0m')
+
+    # Build the skeleton of the tree of the sample at this rank just once
+    flat: FlatTree = FlatTree.from_sample(taxonomy=taxonomy,
+                                          counts=counts[raw],
+                                          scores=scores[raw],
+                                          min_rank=rank,
+                                          just_min_rank=True,
+                                          include=including,
+                                          exclude=excluding)
+    exclude_tree = TaxTree()
+    exclude_out = SampleDataByTaxId(['counts', 'scores', 'accs'])
+    exclude_tree.allin1_from(flat, min_taxa=mintaxa, exclude=exclude,
+                             out=exclude_out)
+    exclude_out.purge_counters()
+    if exclude_out.counts:  # Avoid adding empty samples
+        output.write('\033[92m OK! \033[0m\n')
+    else:
+        exclude_out = None
+        output.write('\033[93m VOID \033[0m\n')
+
+    # Get partial abundance and score for the shared analysis
+    sub_shared_tree = TaxTree()
+    sub_shared_out = SampleDataByTaxId(['shared', 'accs'])
+    sub_shared_tree.allin1_from(flat, min_taxa=mintaxa, out=sub_shared_out)
+    sub_shared_out.purge_counters()
+
+    # Control analysis: exclude control taxa from the sample
+    ctrl_out: SampleDataByTaxId = None
+    if ctrl_exclude is not None:
+        ctrl_output.write(gray('  Ctrl: From') + f' {raw} ' +
+                          gray(f'excluding {len(ctrl_exclude)} ctrl taxa. '
+                               f'Generating sample... '))
+        ctrl_tree = TaxTree()
+        ctrl_out = SampleDataByTaxId(['counts', 'scores', 'accs'])
+        ctrl_tree.allin1_from(flat, min_taxa=mintaxa, exclude=ctrl_exclude,
+                              out=ctrl_out)
+        ctrl_out.purge_counters()
+        if ctrl_out.counts:  # Avoid adding empty samples
+            ctrl_output.write(green('OK!\n'))
         else:
-            output.write('\033[93m VOID \033[0m\n')
-
-        # Get partial abundance and score for the shared analysis
-        sub_shared_tree = TaxTree()
-        sub_shared_out = SampleDataByTaxId(['shared', 'accs'])
-        sub_shared_tree.allin1(taxonomy=taxonomy,
-                               counts=counts[raw],
-                               scores=scores[raw],
-                               min_taxa=mintaxa,
-                               min_rank=rank,
-                               just_min_rank=True,
-                               include=including,
-                               exclude=excluding,
-                               out=sub_shared_out)
-        sub_shared_out.purge_counters()
-        # Scale scores by abundance
-        sub_shared_counts: SharedCounter = sub_shared_out.get_shared_counts()
-        sub_shared_score: SharedCounter = sub_shared_out.get_shared_scores()
-        sub_shared_score *= sub_shared_counts
-        partial_shared_update(iteration)
-
-    def shared_analysis():
-        """Perform last steps of shared taxa analysis"""
+            ctrl_out = None
+            ctrl_output.write(yellow('VOID\n'))
+    return (output.getvalue(), exclude_out, sub_shared_out,
+            ctrl_output.getvalue(), ctrl_out)
+
+
+def shared_average(sub_shareds: List[SampleDataByTaxId],
+                   first: int = 0,
+                   positive: bool = True,
+                   ) -> Tuple[SharedCounter, SharedCounter]:
+    """
+    Get the averaged counts and scores of the taxa shared by samples.
+
+    The partial shared data of the samples are aligned in taxa x
+    samples matrices, so the counts and the count-weighted scores of
+    the taxa present in all the samples are accumulated (sample after
+    sample, so the sums are the same as folding with SharedCounter)
+    and averaged with a few array operations.
+
+    Args:
+        sub_shareds: Partial shared data of the samples, in order.
+        first: Index of the first sample to be considered.
+        positive: If True, the taxa whose accumulated counts are not
+            positive are removed from the counts, otherwise they are
+            kept (anyway, they never have a score).
+
+    Returns:
+        Counts accumulated and divided (floor) by the number of
+        samples, and scores weighted by the counts of the samples, in
+        the order of the taxa in the last sample.
+
+    """
+    subs: List[SampleDataByTaxId] = sub_shareds[first:]
+    if not subs:
+        return SharedCounter(), SharedCounter()
+    index: Dict[TaxId, int] = {}
+    for sub in subs:
+        for tid in sub.get_shared_counts():
+            index.setdefault(tid, len(index))
+    taxa: np.ndarray = np.array(list(index), dtype=object)
+    counts: np.ndarray = np.zeros((len(index), len(subs)), dtype=np.int64)
+    scores: np.ndarray = np.zeros((len(index), len(subs)))
+    in_counts: np.ndarray = np.zeros((len(index), len(subs)), dtype=bool)
+    in_scores: np.ndarray = np.zeros((len(index), len(subs)), dtype=bool)
+    for col, sub in enumerate(subs):
+        sub_counts: SharedCounter = sub.get_shared_counts()
+        sub_scores: SharedCounter = sub.get_shared_scores()
+        rows: List[int] = [index[tid] for tid in sub_counts]
+        counts[rows, col] = list(sub_counts.values())
+        in_counts[rows, col] = True
+        rows = [index[tid] for tid in sub_scores if tid in sub_counts]
+        scores[rows, col] = [sub_scores[tid] for tid in sub_scores
+                             if tid in sub_counts]
+        in_scores[rows, col] = True
+    scores *= counts  # Scale scores by abundance
+    acc_counts: np.ndarray = counts[:, 0].copy()
+    acc_scores: np.ndarray = scores[:, 0].copy()
+    for col in range(1, len(subs)):
+        acc_counts += counts[:, col]
+        acc_scores += scores[:, col]
+    shared: np.ndarray = in_counts.all(axis=1)
+    valid: np.ndarray = shared & (acc_counts > 0)
+    if positive:
+        shared = valid
+    valid = valid & in_scores.all(axis=1)
+    acc_scores[valid] /= acc_counts[valid]  # Normalize by total abundance
+    acc_counts //= len(subs)  # Get averaged abundance by number of samples
+
+    def in_last_order(keys: List[TaxId], selected: np.ndarray,
+                      values: np.ndarray) -> SharedCounter:
+        """Get the selected values in the order of the given keys"""
+        rows: np.ndarray = np.array([index[tid] for tid in keys],
+                                    dtype=np.int64)
+        rows = rows[selected[rows]]
+        return SharedCounter(dict(zip(taxa[rows], values[rows].tolist())))
+
+    last_counts: SharedCounter = subs[-1].get_shared_counts()
+    return (in_last_order(list(last_counts), shared, acc_counts),
+            in_last_order([tid for tid in subs[-1].get_shared_scores()
+                           if tid in last_counts], valid, acc_scores))
+
+
+def shared_analysis(*args,
+                    **kwargs
+                    ) -> Tuple[str, SampleDataByTaxId,
+                               str, SampleDataByTaxId]:
+    """
+    Shared and control-shared analysis for a taxlevel (reduction step).
+
+    The partial shared data of all the samples (from cross_analysis),
+    in the order of the raw samples, are reduced here. The control
+    shared analysis is performed if the set with the taxa to exclude
+    (from control_exclusions) is given.
+
+    Returns:
+        Log string of the shared analysis, shared sample data (None if
+        void), log string of the control-shared analysis and its
+        sample data (None if void or not done).
+
+    """
+    # Recover input and parameters (the rank in args[0] just keys the task)
+    sub_shareds: List[SampleDataByTaxId] = args[1]
+    exclude_candidates: Set[TaxId] = args[2]
+    controls: int = kwargs['controls']
+    mintaxa = kwargs['mintaxa']
+    taxonomy: Taxonomy = kwargs['taxonomy']
+    including = taxonomy.including
+    excluding = taxonomy.excluding
+    raws: List[Sample] = kwargs['raw_samples']
+    output: io.StringIO = io.StringIO(newline='')
+    ctrl_output: io.StringIO = io.StringIO(newline='')
+
+    # Shared taxa final analysis
+    shared_out: SampleDataByTaxId = None
+    shared_counts: SharedCounter
+    shared_score: SharedCounter
+    shared_counts, shared_score = shared_average(sub_shareds)
+    if shared_counts:
         shared_tree: TaxTree = TaxTree()
-        shared_out: SampleDataByTaxId = SampleDataByTaxId(['shared', 'accs'])
+        shared_out = SampleDataByTaxId(['shared', 'accs'])
         shared_tree.allin1(taxonomy=taxonomy,
                            counts=shared_counts,
                            scores=shared_score,
@@ -169,167 +577,25 @@ def process_rank(*args,
         output.write(gray(f'  Shared: Including {len(out_counts)}'
                           ' shared taxa. Generating sample... '))
         if out_counts:
-            sample = Sample(f'{STR_SHARED}_{rank.name.lower()}')
-            samples.append(sample)
-            counts[Sample(sample)] = out_counts
-            accs[Sample(sample)] = shared_out.get_accs()
-            scores[sample] = shared_out.get_shared_scores()
             output.write(green('OK!\n'))
         else:
+            shared_out = None
             output.write(yellow('VOID\n'))
+    else:
+        output.write(gray('  Shared: No shared taxa! ') +
+                     yellow('VOID') + gray(' sample.\n'))
 
-    def control_analysis():
-        """Perform last steps of control and shared controls analysis"""
-        nonlocal shared_ctrl_counts, shared_ctrl_score
-
-        def robust_contamination_removal():
-            """Implement robust contamination removal algorithm."""
-            nonlocal exclude_sets
-
-            def compute_qn(data: List[float], dist: str = "Gauss") -> float:
-                """Compute Qn robust estimator of scale (Rousseeuw, 1993)"""
-                c_d: float  # Select d parameter depending on the distribution
-                if dist == "Gauss":
-                    c_d = 2.2219
-                elif dist == "Cauchy":  # Heavy-tailed distribution
-                    c_d = 1.2071
-                elif dist == "NegExp":  # Negative exponential (asymetric)
-                    c_d = 3.4760
-                else:
-                    raise Exception(red('\nERROR! ') + 'Unknown distribution')
-                num: int = len(data)
-                sort_data = sorted(data)
-                pairwisedifs: List[float] = []
-                for (i, x_val) in enumerate(sort_data):
-                    for y_val in sort_data[i + 1:]:
-                        pairwisedifs.append(abs(x_val - y_val))
-                k: int = int(num * (num / 2 + 1) / 4)
-                return c_d * sorted(pairwisedifs)[k - 1]
-
-            exclude_sets = {smpl: set() for smpl in raws[controls:]}
-            vwrite(gray('Robust contamination removal: '
-                        'Searching for contaminants...\n'))
-            for tid in exclude_candidates:
-                relfreq_ctrl: List[float] = [accs[ctrl][tid] / accs[ctrl][ROOT]
-                                             for ctrl in raws[:controls]]
-                relfreq_smpl: List[float] = [accs[smpl][tid] / accs[smpl][ROOT]
-                                             for smpl in raws[controls:]]
-                relfreq: List[float] = relfreq_ctrl + relfreq_smpl
-                crossover: List[bool] = None  # Crossover source (yes/no)
-                # Just-controls contamination check
-                if all([rf < EPS for rf in relfreq_smpl]):
-                    vwrite(cyan('just-ctrl:\t'), tid, taxonomy.get_name(tid),
-                           gray('relfreq:'), fltlst2str(relfreq_ctrl) +
-                           fltlst2str(relfreq_smpl), '\n')
-                    continue  # Go for next candidate
-                # Critical contamination check
-                if all([rf > SEVR_CONTM_MIN_RELFREQ for rf in relfreq_ctrl]):
-                    vwrite(red('critical:\t'), tid, taxonomy.get_name(tid),
-                           gray('relfreq:'), fltlst2str(relfreq_ctrl) +
-                           fltlst2str(relfreq_smpl), '\n')
-                    for exclude_set in exclude_sets.values():
-                        exclude_set.add(tid)
-                    continue  # Go for next candidate
-                # Severe contamination check
-                if any([rf > SEVR_CONTM_MIN_RELFREQ for rf in relfreq_ctrl]):
-                    vwrite(yellow('severe: \t'), tid, taxonomy.get_name(tid),
-                           gray('relfreq:'), fltlst2str(relfreq_ctrl) +
-                           fltlst2str(relfreq_smpl), '\n')
-                    for exclude_set in exclude_sets.values():
-                        exclude_set.add(tid)
-                    continue  # Go for next candidate
-                # Mild contamination check
-                if all([rf > MILD_CONTM_MIN_RELFREQ for rf in relfreq_ctrl]):
-                    vwrite(blue('mild cont:\t'), tid, taxonomy.get_name(tid),
-                           gray('relfreq:'), fltlst2str(relfreq_ctrl) +
-                           fltlst2str(relfreq_smpl), '\n')
-                    for exclude_set in exclude_sets.values():
-                        exclude_set.add(tid)
-                    continue  # Go for next candidate
-                # Calculate median and MAD median but including controls
-                mdn: float = statistics.median(relfreq)
-                # mad:float=statistics.mean([abs(mdn - rf) for rf in relfreq])
-                q_n: float = compute_qn(relfreq, dist="NegExp")
-                # Calculate crossover in samples
-                outlier_lim: float = mdn + ROBUST_XOVER_OUTLIER * q_n
-                ordomag_lim: float = max(relfreq_ctrl)*10**ROBUST_XOVER_ORD_MAG
-                crossover = [rf > outlier_lim and rf > ordomag_lim
-                             for rf in relfreq[controls:]]
-                # Crossover contamination check
-                if any(crossover):
-                    vwrite(magenta('crossover:\t'), tid,
-                           taxonomy.get_name(tid), green(
-                            f'lims: [{outlier_lim:.1g}]' + (
-                                '<' if outlier_lim < ordomag_lim else '>') +
-                            f'[{ordomag_lim:.1g}]'),
-                           gray('relfreq:'), fltlst2str(relfreq_ctrl) +
-                           fltlst2str(relfreq_smpl),
-                           gray('crossover:'), blst2str(crossover), '\n')
-                    # Exclude just for contaminated samples (not the source)
-                    vwrite(magenta('\t->'), gray(f'Include {tid} just in:'))
-                    for i in range(len(raws[controls:])):
-                        if not crossover[i]:
-                            exclude_sets[raws[i + controls]].add(tid)
-                        else:
-                            vwrite(f' {raws[i + controls]}')
-                    vwrite('\n')
-                    continue
-                # Other contamination: remove from all samples
-                vwrite(gray('other cont:\t'), tid, taxonomy.get_name(tid),
-                       green(f'lims: [{outlier_lim:.1g}]' + (
-                                '<' if outlier_lim < ordomag_lim else '>') +
-                             f'[{ordomag_lim:.1g}]'),
-                       gray('relfreq:'), fltlst2str(relfreq_ctrl) +
-                           fltlst2str(relfreq_smpl), '\n')
-                for exclude_set in exclude_sets.values():
-                    exclude_set.add(tid)
-
-        # Get taxids at this rank that are present in the control samples
-        exclude_candidates = set()
-        for i in range(controls):
-            exclude_candidates.update(taxids[raws[i]][rank])
-        exclude_sets: Dict[Sample, Set[TaxId]]
-        if controls and (len(raws) - controls >= ROBUST_MIN_SAMPLES):
-            robust_contamination_removal()
-        else:  # If this case, just apply strict control
-            exclude_sets = {file: exclude_candidates
-                            for file in raws[controls::]}
-        # Add explicit excluding taxa (if any) to exclude sets
-        for exclude_set in exclude_sets.values():
-            exclude_set.update(excluding)
-        exclude_candidates.update(excluding)
-        # Process each sample excluding control taxa
-        for raw in raws[controls:]:
-            output.write(gray('  Ctrl: From') + f' {raw} ' +
-                         gray(f'excluding {len(exclude_sets[raw])} ctrl taxa. '
-                              f'Generating sample... '))
-            ctrl_tree = TaxTree()
-            ctrl_out = SampleDataByTaxId(['counts', 'scores', 'accs'])
-            ctrl_tree.allin1(taxonomy=taxonomy,
-                             counts=counts[raw],
-                             scores=scores[raw],
-                             min_taxa=mintaxa,
-                             min_rank=rank,
-                             just_min_rank=True,
-                             include=including,
-                             exclude=exclude_sets[raw],
-                             out=ctrl_out)
-            ctrl_out.purge_counters()
-            if ctrl_out.counts:  # Avoid adding empty samples
-                sample = Sample(f'{raw}_{STR_CONTROL}_{rank.name.lower()}')
-                samples.append(sample)
-                counts[sample] = ctrl_out.get_counts()
-                accs[sample] = ctrl_out.get_accs()
-                scores[sample] = ctrl_out.get_scores()
-                output.write(green('OK!\n'))
-            else:
-                output.write(yellow('VOID\n'))
-
-        def shared_ctrl_analysis():
-            """Perform last steps of shared taxa analysis"""
+    # Shared-control taxa final analysis
+    shared_ctrl_out: SampleDataByTaxId = None
+    if exclude_candidates is not None:
+        shared_ctrl_counts: SharedCounter = SharedCounter()
+        shared_ctrl_score: SharedCounter = SharedCounter()
+        if controls < len(raws):
+            shared_ctrl_counts, shared_ctrl_score = shared_average(
+                sub_shareds, first=controls, positive=False)
+        if shared_ctrl_counts:
             shared_ctrl_tree: TaxTree = TaxTree()
-            shared_ctrl_out: SampleDataByTaxId = SampleDataByTaxId(
-                ['shared', 'accs'])
+            shared_ctrl_out = SampleDataByTaxId(['shared', 'accs'])
             shared_ctrl_tree.allin1(taxonomy=taxonomy,
                                     counts=shared_ctrl_counts,
                                     scores=shared_ctrl_score,
@@ -338,54 +604,119 @@ def process_rank(*args,
                                     exclude=exclude_candidates,
                                     out=shared_ctrl_out)
             shared_ctrl_out.purge_counters()
-            out_counts: SharedCounter = shared_ctrl_out.get_shared_counts()
-            output.write(gray(f'  Ctrl-shared: Including {len(out_counts)}'
-                              ' shared taxa. Generating sample... '))
+            out_counts = shared_ctrl_out.get_shared_counts()
+            ctrl_output.write(gray(f'  Ctrl-shared: Including '
+                                   f'{len(out_counts)} shared taxa. '
+                                   f'Generating sample... '))
             if out_counts:
-                sample = Sample(f'{STR_CONTROL_SHARED}_{rank.name.lower()}')
-                samples.append(sample)
-                counts[Sample(sample)] = out_counts
-                accs[Sample(sample)] = shared_ctrl_out.get_accs()
-                scores[sample] = shared_ctrl_out.get_shared_scores()
-                output.write(green('OK!\n'))
+                ctrl_output.write(green('OK!\n'))
             else:
-                output.write(yellow('VOID\n'))
-
-        # Shared-control taxa final analysis
-        if shared_ctrl_counts:
-            # Normalize scaled scores by total abundance
-            shared_ctrl_score /= (+shared_ctrl_counts)
-            # Get averaged abundance by number of samples minus ctrl samples
-            shared_ctrl_counts //= (len(raws) - controls)
-            shared_ctrl_analysis()
+                shared_ctrl_out = None
+                ctrl_output.write(yellow('VOID\n'))
         else:
-            output.write(gray('  Ctrl-shared: No taxa! ') +
-                         yellow('VOID') + gray(' sample.\n'))
+            ctrl_output.write(gray('  Ctrl-shared: No taxa! ') +
+                              yellow('VOID') + gray(' sample.\n'))
+    return (output.getvalue(), shared_out,
+            ctrl_output.getvalue(), shared_ctrl_out)
+
+
+def process_ranks(executor: Executor,
+                  ranks: List[Rank],
+                  ) -> Tuple[List[Sample],
+                             Dict[Sample, UnionCounter],
+                             Dict[Sample, Counter[TaxId]],
+                             Dict[Sample, UnionScores],
+                             Dict[str, Dict[Rank, Sample]]]:
+    """
+    Process results for several taxlevels with fine-grained tasks.
 
-    # Cross analysis iterating by output: exclusive and part of shared&ctrl
-    for num_file, raw_sample_name in enumerate(raws):
-        cross_analysis(num_file, raw_sample_name)
+    The presence bitmaps of the taxa for each rank are shared first,
+    then the tasks are submitted to the executor in three steps: the
+    control taxa to exclude for each rank, the cross analysis for each
+    (rank, sample) pair, and the shared analysis (reduction) for each
+    rank. The log is printed rank by rank, in order.
 
-    # Shared taxa final analysis
-    shared_counts = +shared_counts  # remove counts <= 0
-    if shared_counts:
-        # Normalize scaled scores by total abundance (after eliminating zeros)
-        shared_score /= (+shared_counts)
-        # Get averaged abundance by number of samples
-        shared_counts //= len(raws)
-        shared_analysis()
-    else:
-        output.write(gray('  Shared: No shared taxa! ') +
-                     yellow('VOID') + gray(' sample.\n'))
+    Args:
+        executor: Executor sharing the parameters and the data of the
+            raw samples ('taxids', 'counts', 'scores', 'accs' and
+            'raw_samples') with the tasks.
+        ranks: List of taxonomic ranks to process.
 
-    # Control sample subtraction
-    if controls:
-        control_analysis()
+    Returns:
+        List of the new samples, dicts with their counts, accumulated
+        counts and scores, and index of the new samples: a dict with
+        the samples by rank for each analysis (the summary targets,
+        i.e., raw sample and study or just study for shared ones).
 
-    # Print output and return
-    print(output.getvalue())
-    sys.stdout.flush()
-    return samples, counts, accs, scores
+    """
+    controls: int = executor.kwargs['controls']
+    raws: List[Sample] = executor.kwargs['raw_samples']
+    raw_counts: Dict[Sample, UnionCounter] = executor.kwargs['counts']
+    taxids: Dict[Sample, TaxLevels] = executor.kwargs['taxids']
+
+    # Declare/define variables
+    samples: List[Sample] = []
+    counts: Dict[Sample, UnionCounter] = {}
+    accs: Dict[Sample, Counter[TaxId]] = {}
+    scores: Dict[Sample, UnionScores] = {}
+    derived: Dict[str, Dict[Rank, Sample]] = {}
+
+    def add_sample(analysis: str, rank: Rank,
+                   out: SampleDataByTaxId) -> None:
+        """Add and index the data of a new (not void) sample"""
+        if out is not None:
+            sample = Sample(f'{analysis}_{rank.name.lower()}')
+            samples.append(sample)
+            counts[sample] = out.counts
+            accs[sample] = out.accs
+            scores[sample] = out.scores
+            derived.setdefault(analysis, {})[rank] = sample
+
+    executor.share(presence={rank: presence_bitmap(taxids, raws, rank)
+                             for rank in ranks})
+    exclusions: List[Tuple[str, Dict[Sample, Set[TaxId]], Set[TaxId]]] = [
+        ('', {}, None) for _ in ranks]
+    if controls:
+        exclusions = executor.map(control_exclusions, ranks)
+    pairs: List[Tuple[int, Sample]] = [
+        (num, raw) for num in range(len(ranks)) for raw in raws]
+    crosses: List[Tuple[str, SampleDataByTaxId, SampleDataByTaxId,
+                        str, SampleDataByTaxId]] = executor.map(
+        cross_analysis,
+        [ranks[num] for num, _ in pairs],
+        [raw for _, raw in pairs],
+        [exclusions[num][1].get(raw) for num, raw in pairs],
+        weights=[len(raw_counts[raw]) for _, raw in pairs])
+    shareds: List[Tuple[str, SampleDataByTaxId,
+                        str, SampleDataByTaxId]] = executor.map(
+        shared_analysis,
+        ranks,
+        [[cross[2] for cross in crosses[num * len(raws):
+                                        (num + 1) * len(raws)]]
+         for num in range(len(ranks))],
+        [exclusion[2] for exclusion in exclusions])
+
+    for num, rank in enumerate(ranks):
+        output: io.StringIO = io.StringIO(newline='')
+        output.write(f'\033[90mAnalysis for taxonomic rank "'
+                     f'\033[95m{rank.name.lower()}\033[90m":\033[0m\n')
+        rank_crosses = crosses[num * len(raws):(num + 1) * len(raws)]
+        shared_log, shared_out, ctrl_shared_log, ctrl_shared_out = shareds[num]
+        for raw, (log, exclude_out, _, _, _) in zip(raws, rank_crosses):
+            output.write(log)
+            add_sample(f'{raw}_{STR_EXCLUSIVE}', rank, exclude_out)
+        output.write(shared_log)
+        add_sample(STR_SHARED, rank, shared_out)
+        if controls:
+            output.write(exclusions[num][0])
+            for raw, (_, _, _, log, ctrl_out) in zip(raws, rank_crosses):
+                output.write(log)
+                add_sample(f'{raw}_{STR_CONTROL}', rank, ctrl_out)
+            output.write(ctrl_shared_log)
+            add_sample(STR_CONTROL_SHARED, rank, ctrl_shared_out)
+        print(output.getvalue())
+        sys.stdout.flush()
+    return samples, counts, accs, scores, derived
 
 
 def summarize_analysis(*args,
@@ -396,47 +727,46 @@ def summarize_analysis(*args,
                                   Scores]:
     """
     Summarize for a cross-analysis (to be usually called in parallel!).
+
+    The arguments are the name of the analysis and the list of its
+    samples (see the index returned by process_ranks).
     """
     # Recover input and parameters
     analysis: str = args[0]
+    target_samples: List[Sample] = args[1]
     taxonomy: Taxonomy = kwargs['taxonomy']
     including = taxonomy.including
     excluding = taxonomy.excluding
     counts: Dict[Sample, Counter[TaxId]] = kwargs['counts']
+    accs: Dict[Sample, Counter[TaxId]] = kwargs['accs']
     scores: Dict[Sample, Dict[TaxId, Score]] = kwargs['scores']
-    samples: List[Sample] = kwargs['samples']
     output: io.StringIO = io.StringIO(newline='')
 
     # Declare/define variables
-    summary_counts: Counter[TaxId] = Counter()
-    summary_acc: Counter[TaxId] = Counter()
-    summary_score: Scores = Scores({})
+    summary_counts: Counter[TaxId]
+    summary_acc: Counter[TaxId]
+    summary_score: Scores
     summary: Sample = None
 
     output.write(gray('Summary for ') + analysis + gray('... '))
 
-    target_samples: List[Sample] = [smpl for smpl in samples
-                                    if smpl.startswith(analysis)]
     assert len(target_samples) >= 1, \
         red('ERROR! ') + analysis + gray(' has no samples to summarize!')
-    for smpl in target_samples:
-        summary_counts += counts[smpl]
-        summary_score.update(scores[smpl])
-
-    tree = TaxTree()
-    tree.grow(taxonomy=taxonomy,
-              counts=summary_counts,
-              scores=summary_score)
-    tree.subtract()
-    tree.shape()
-    summary_counts.clear()
-    summary_score.clear()
-    tree.get_taxa(abundance=summary_counts,
-                  accs=summary_acc,
-                  scores=summary_score,
-                  include=including,
-                  exclude=excluding)
-    summary_counts = +summary_counts  # remove counts <= 0
+    # Merge the trees of the samples (from their accumulated counts)
+    flat: FlatTree = FlatTree.from_samples(
+        taxonomy=taxonomy,
+        counts=[counts[smpl] for smpl in target_samples],
+        accs=[accs[smpl] for smpl in target_samples],
+        scores=[scores[smpl] for smpl in target_samples],
+        include=including,
+        exclude=excluding)
+    new_counts: np.ndarray = flat.subtract()
+    new_accs, new_scores = flat.shape(new_counts)
+    out = SampleDataByTaxId(['counts', 'scores', 'accs'])
+    flat.collect(new_accs > 0, new_counts, new_accs, new_scores, out)
+    summary_acc = out.get_accs()
+    summary_score = out.get_scores()
+    summary_counts = +out.get_counts()  # remove counts <= 0
     if summary_counts:  # Avoid returning empty sample (summary would be None)
         summary = Sample(f'{analysis}_{STR_SUMMARY}')
         output.write(gray('(') + cyan(f'{len(target_samples)}') +
@@ -449,6 +779,28 @@ def summarize_analysis(*args,
     return summary, summary_counts, summary_acc, summary_score
 
 
+def krona_branch(*args,
+                 **kwargs
+                 ) -> None:
+    """
+    Write the Krona nodes of a branch (to be usually called in parallel!).
+
+    The arguments are the taxid of the root of the branch, its subtree
+    (see MultiTree.split), the name of the file to write its nodes to,
+    and the serialization method (see KronaTree.write_nodes). Just the
+    subtree of the branch is sent to the worker, not the whole tree.
+    """
+    tid: TaxId = args[0]
+    branch: MultiTree = args[1]
+    filename: Filename = args[2]
+    method: str = args[3]
+    tree: MultiTree = MultiTree(samples=branch.samples)
+    tree[tid] = branch
+    with open(filename, 'w') as file:
+        kwargs['krona'].write_nodes(
+            file, tree.iter_krona(kwargs['taxonomy']), method)
+
+
 def write_lineage(parents: Parents,
                   names: Dict[TaxId, str],
                   tree: TaxTree,
@@ -305,6 +305,8 @@ var currentDataset = 0;
 var lastDataset = 0;
 var datasets = 1;
 var datasetNames;
+var compactRanks;  // Dictionary of ranks, only if compact encoding of nodes
+var lazyDatasets;  // Chunks of values of datasets to be decoded on demand
 const DATASET_MAX_SIZE = 20;  // Max size in rows of the dataset selection list
 var datasetsVisible = 1; // Number of datasets not hidden
 var datasetAlpha = new Tween(0, 0);
@@ -4766,6 +4768,11 @@ function load() {
         showKeys = kronaElement.getAttribute('key') == 'true';
     }
 
+    if (kronaElement.getAttribute('lazy') == 'true') {
+        lazyDatasets = new Object();
+        lazyDatasets.chunks = [];
+    }
+
     for
     (
         var element = getFirstChild(kronaElement);
@@ -4904,6 +4911,13 @@ function load() {
                 datasets = datasetNames.length;
                 break;
 
+            case 'ranks':
+                compactRanks = [];
+                for (var j = getFirstChild(element); j; j = getNextSibling(j)) {
+                    compactRanks.push(j.firstChild.nodeValue);
+                }
+                break;
+
             case 'node':
                 head = loadTreeDOM
                 (
@@ -4916,9 +4930,23 @@ function load() {
                     valueEnd
                 );
                 break;
+
+            case 'chunk':
+                lazyDatasets.chunks[Number(element.getAttribute('dataset'))] =
+                    element.firstChild ? element.firstChild.nodeValue : '';
+                break;
         }
     }
 
+    if (lazyDatasets) {
+        lazyDatasets.hueName = hueName;
+        lazyDatasets.hueStart = hueStart;
+        lazyDatasets.hueEnd = hueEnd;
+        lazyDatasets.valueStart = valueStart;
+        lazyDatasets.valueEnd = valueEnd;
+        loadDataset(0);
+    }
+
     // get GET options
     //
     var urlHalves = String(document.location).split('?');
@@ -5010,7 +5038,10 @@ function loadTreeDOM
 
     newNode.name = domNode.getAttribute('name');
 
-    if (domNode.getAttribute('href')) {
+    if (compactRanks) {
+        newNode.href = 'https://www.google.es/search?q=' + newNode.name;
+    }
+    else if (domNode.getAttribute('href')) {
         newNode.href = domNode.getAttribute('href');
     }
 
@@ -5018,6 +5049,20 @@ function loadTreeDOM
         newNode.hues = new Array();
     }
 
+    if (compactRanks) {
+        loadCompactValues
+        (
+            domNode,
+            newNode,
+            magnitudeName,
+            hueName,
+            hueStart,
+            hueEnd,
+            valueStart,
+            valueEnd
+        );
+    }
+
     for (var i = getFirstChild(domNode); i; i = getNextSibling(i)) {
         switch (i.tagName.toLowerCase()) {
             case 'node':
@@ -5059,16 +5104,8 @@ function loadTreeDOM
                         var value = j.firstChild ? j.firstChild.nodeValue : '';
 
                         if (j.getAttribute('href')) {
-                            var target;
-
-                            if (attributes[index].target) {
-                                target = ' target="'
-                                    + attributes[index].target + '"';
-                            }
-
-                            value = '<a href="' + attributes[index].hrefBase
-                                + j.getAttribute('href') + '"'
-                                + target + '>' + value + '</a>';
+                            value = hrefValue(index, j.getAttribute('href'),
+                                value);
                         }
 
                         newNode.attributes[index].push(value);
@@ -5077,44 +5114,194 @@ function loadTreeDOM
                 //
                 if (attributeName == magnitudeName
                     || attributeName == hueName) {
-                    for (j = 0; j < datasets; j++) {
-                        // j is the dataset index (goes from 0 to datasets-1)
-                        var value = newNode.attributes[index][j]
-                        == undefined ? 0 : Number(newNode.attributes[index][j]);
+                    setNumericValues
+                    (
+                        newNode,
+                        index,
+                        attributeName == hueName,
+                        hueStart,
+                        hueEnd,
+                        valueStart,
+                        valueEnd
+                    );
+                }
+                break;
+        }
+    }
 
-                        newNode.attributes[index][j] = value;
+    return newNode;
+}
 
-                        if (attributeName == hueName) {
-                            var hue = lerp
-                            (
-                                value,
-                                valueStart,
-                                valueEnd,
-                                hueStart,
-                                hueEnd
-                            );
-
-                            if (hue < hueStart == hueStart < hueEnd) {
-                                hue = hueStart;
-                            }
-                            else if (hue > hueEnd == hueStart < hueEnd) {
-                                hue = hueEnd;
-                            }
+function loadCompactValues
+(domNode,
+ newNode,
+ magnitudeName,
+ hueName,
+ hueStart,
+ hueEnd,
+ valueStart,
+ valueEnd) {
+    // Decode the values of a node in the compact encoding, stored in
+    // attributes of the node: the values of the datasets as a sparse list
+    // of index:value pairs, and the rank as an index in the dictionary
+    for (var index = 0; index < attributes.length; index++) {
+        var attributeName = attributes[index].name;
+        var data = domNode.getAttribute(attributeName);
 
-                            newNode.hues[j] = hue;
-                        }
-                    }
+        if (data == undefined) {
+            if (!lazyDatasets || attributes[index].mono) {
+                continue;
+            }
+            data = '';  // Values of the datasets to be loaded on demand
+        }
 
-                    if (attributeName == hueName) {
-                        newNode.hue = new Tween(newNode.hues[0],
-                            newNode.hues[0]);
-                    }
+        if (attributeName == 'rank') {
+            newNode.attributes[index] = [compactRanks[Number(data)]];
+        }
+        else if (attributes[index].mono) {
+            newNode.attributes[index] = [attributes[index].hrefBase ?
+                hrefValue(index, data, data) : data];
+        }
+        else {
+            newNode.attributes[index] = new Array();
+
+            for (var j = 0; j < datasets; j++) {
+                newNode.attributes[index].push('');
+            }
+
+            var pairs = data.split(',');
+
+            for (var j = 0; j < pairs.length; j++) {
+                if (pairs[j]) {
+                    var pair = pairs[j].split(':');
+                    newNode.attributes[index][Number(pair[0])] = pair[1];
                 }
-                break;
+            }
+        }
+        //
+        if (attributeName == magnitudeName || attributeName == hueName) {
+            setNumericValues
+            (
+                newNode,
+                index,
+                attributeName == hueName,
+                hueStart,
+                hueEnd,
+                valueStart,
+                valueEnd
+            );
         }
     }
+}
 
-    return newNode;
+function hueValue(value, hueStart, hueEnd, valueStart, valueEnd) {
+    var hue = lerp
+    (
+        value,
+        valueStart,
+        valueEnd,
+        hueStart,
+        hueEnd
+    );
+
+    if (hue < hueStart == hueStart < hueEnd) {
+        hue = hueStart;
+    }
+    else if (hue > hueEnd == hueStart < hueEnd) {
+        hue = hueEnd;
+    }
+
+    return hue;
+}
+
+function loadDataset(dataset) {
+    // Decode the chunk with the unassigned and score values of a lazy
+    // dataset, if not done yet: a list of nodes (by the gap to the index
+    // of the previous one) with their values, if any of them is nonzero
+    if (!lazyDatasets || lazyDatasets.chunks[dataset] == undefined) {
+        return;
+    }
+
+    var unassignedIndex = attributeIndex('unassigned');
+    var scoreIndex = attributeIndex('score');
+    var isHue = lazyDatasets.hueName == 'score';
+    var entries = lazyDatasets.chunks[dataset].split(',');
+    var nodeIndex = 0;
+
+    delete lazyDatasets.chunks[dataset];
+
+    for (var i = 0; i < entries.length; i++) {
+        if (!entries[i]) {
+            continue;
+        }
+
+        var entry = entries[i].split(':');
+        nodeIndex += Number(entry[0]);
+        var node = nodes[nodeIndex];
+        node.attributes[unassignedIndex][dataset] = entry[1];
+        node.attributes[scoreIndex][dataset] = Number(entry[2]);
+
+        if (isHue) {
+            node.hues[dataset] = hueValue
+            (
+                Number(entry[2]),
+                lazyDatasets.hueStart,
+                lazyDatasets.hueEnd,
+                lazyDatasets.valueStart,
+                lazyDatasets.valueEnd
+            );
+
+            if (dataset == 0) {
+                node.hue = new Tween(node.hues[0], node.hues[0]);
+            }
+        }
+    }
+}
+
+function hrefValue(index, href, value) {
+    var target;
+
+    if (attributes[index].target) {
+        target = ' target="'
+            + attributes[index].target + '"';
+    }
+
+    return '<a href="' + attributes[index].hrefBase
+        + href + '"'
+        + target + '>' + value + '</a>';
+}
+
+function setNumericValues
+(newNode,
+ index,
+ isHue,
+ hueStart,
+ hueEnd,
+ valueStart,
+ valueEnd) {
+    for (var j = 0; j < datasets; j++) {
+        // j is the dataset index (goes from 0 to datasets-1)
+        var value = newNode.attributes[index][j]
+        == undefined ? 0 : Number(newNode.attributes[index][j]);
+
+        newNode.attributes[index][j] = value;
+
+        if (isHue) {
+            newNode.hues[j] = hueValue
+            (
+                value,
+                hueStart,
+                hueEnd,
+                valueStart,
+                valueEnd
+            );
+        }
+    }
+
+    if (isHue) {
+        newNode.hue = new Tween(newNode.hues[0],
+            newNode.hues[0]);
+    }
 }
 
 function maxAbsoluteDepthDecrease() {
@@ -5712,6 +5899,7 @@ function setCallBacks() {
 }
 
 function selectDataset(newDataset) {
+    loadDataset(newDataset);
     lastDataset = currentDataset;
     currentDataset = newDataset
     if (datasets > 1) {
@@ -4,15 +4,19 @@ Classes and functions directly related with Krona.
 """
 # pylint: disable=not-an-iterable
 import csv
-import html
+import io
 import os
+import shutil
 import subprocess
-from typing import List, Dict, NewType, Any, Optional
+import sys
+import tempfile
+from typing import List, Dict, NewType, Any, Optional, Iterable, Tuple, TextIO
+from typing import Union
 import xml.etree.ElementTree as ETree
-from xml.dom import minidom
 
-from recentrifuge.config import JSLIB, HTML_SUFFIX
+from recentrifuge.config import JSLIB, HTML_SUFFIX, LAZY_BUFFER_VALUES
 from recentrifuge.config import Filename, Sample, Scoring, SampleStats
+from recentrifuge.rank import Rank
 
 # from recentrifuge.config import HTML_SUFFIX
 
@@ -20,6 +24,10 @@ from recentrifuge.config import Filename, Sample, Scoring, SampleStats
 # pylint: disable=invalid-name
 Attrib = NewType('Attrib', str)  # Refers to Krona attributes not XML ones
 Elm = ETree.Element
+# Stream of Krona nodes in document order: the name and values of each
+#   node are given when it is opened, and None is given when it is closed;
+#   whole branches may also be given as files with their nodes serialized
+KronaNodes = Iterable[Union[None, Filename, Tuple[str, Dict[Attrib, Any]]]]
 # pylint: enable=invalid-name
 
 # Predefined constants
@@ -29,6 +37,16 @@ TID = Attrib('tid')
 RANK = Attrib('rank')
 SCORE = Attrib('score')
 
+HTML_DOCTYPE: str = '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n'  # pylint: disable=line-too-long
+
+PRETTY_INDENT: str = '  '
+# As ETree and minidom, sort the XML attributes before Python 3.8
+SORTED_ATTRIBUTES: bool = sys.version_info < (3, 8)
+
+# Static assets and precompiled template of the HTML, built once per process
+_ASSETS: Dict[str, str] = {}
+_HTML_TEMPLATE: List[str] = []
+
 # Define encoding dialect for TSV files expected by Krona
 csv.register_dialect('krona', 'unix', delimiter='\t', quoting=csv.QUOTE_NONE)
 
@@ -52,18 +70,20 @@ class KronaTree(ETree.ElementTree):
         return subelement
 
     def node(self,
-             parent: Elm,
              name: str,
              values: Dict[Attrib, Any],
              ) -> Elm:
         """Wrapper for creating a meaningful Krona node.
 
+        The node is created detached from the tree, to be streamed.
         For details, please consult:
         https://github.com/marbl/Krona/wiki/Krona-2.0-XML-Specification
         """
-        subnode = self.sub(parent, 'node',
-                           {'name': name,
-                            'href': f'https://www.google.es/search?q={name}'})
+        if self.compact:
+            return self.compact_node(name, values)
+        attrib: Dict[str, str] = {
+            'name': name, 'href': f'https://www.google.es/search?q={name}'}
+        subnode: Elm = ETree.Element('node', attrib)
         count_node = self.sub(subnode, COUNT)
         counts: Dict[Sample, str] = {sample: values[COUNT][sample]
                                      for sample in self.samples}
@@ -98,18 +118,277 @@ class KronaTree(ETree.ElementTree):
                 self.sub(score_node, 'val', None, scores[sample])
         return subnode
 
+    def sparse(self, values: Dict[Sample, str]) -> str:
+        """Sparse list of the nonzero values of the samples, by index."""
+        return ','.join(f'{num}:{values[sample]}'
+                        for num, sample in enumerate(self.samples)
+                        if float(values[sample]))
+
+    def compact_node(self,
+                     name: str,
+                     values: Dict[Attrib, Any],
+                     ) -> Elm:
+        """Wrapper for creating a Krona node in the compact encoding.
+
+        The values go in attributes of the node instead of subelements:
+        the ones of the samples as sparse lists of index:value pairs,
+        the rank as an index in the dictionary of ranks, and the search
+        link of the name is left to krona.js, which decodes all of them
+        to the very same data of a node in the regular encoding. With
+        lazy datasets, the unassigned and score values are kept apart.
+        """
+        attrib: Dict[str, str] = {'name': name,
+                                  COUNT: self.sparse(values[COUNT])}
+        if self.lazy:
+            self.add_to_chunks(values)
+        elif values.get(UNASSIGNED) and any(values[UNASSIGNED].values()):
+            attrib[UNASSIGNED] = self.sparse(values[UNASSIGNED])
+        if values.get(TID):
+            attrib[TID] = values[TID]
+        if values.get(RANK):
+            attrib[RANK] = str(self.ranks[values[RANK]])
+        if values.get(SCORE) and not self.lazy:
+            attrib[SCORE] = self.sparse(values[SCORE])
+        return ETree.Element('node', attrib)
+
+    def add_to_chunks(self, values: Dict[Attrib, Any]) -> None:
+        """
+        Add the unassigned and score values of a node to the chunks.
+
+        The chunk of every dataset is a list of the nodes (by the gap
+        of their index in document order to the index of the previous
+        one) with their unassigned and score values in that dataset,
+        just for the nodes with any of them nonzero. The chunks are
+        spooled to temporary files, so just a bounded number of values
+        is kept in memory.
+        """
+        unassigned: Dict[Sample, str] = values.get(UNASSIGNED, {})
+        scores: Dict[Sample, str] = values.get(SCORE, {})
+        for num, sample in enumerate(self.samples):
+            unassigned_value: str = unassigned.get(sample, '0')
+            score_value: str = scores.get(sample, '0')
+            if float(unassigned_value) or float(score_value):
+                self.chunks[num].append(
+                    f'{self.num_nodes - self.chunk_nodes[num]}:'
+                    f'{unassigned_value if float(unassigned_value) else ""}:'
+                    f'{score_value if float(score_value) else ""}')
+                self.chunk_nodes[num] = self.num_nodes
+                self.buffered += 1
+        self.num_nodes += 1
+        if self.buffered >= LAZY_BUFFER_VALUES:
+            self.spool_chunks()
+
+    def spool_chunks(self) -> None:
+        """Append the values of the chunks in memory to their files."""
+        if self.spool is None:
+            self.spool = tempfile.mkdtemp(prefix='rcf_chunks_',
+                                          dir=self.tmpdir)
+        for num, chunk in enumerate(self.chunks):
+            if chunk:
+                with open(os.path.join(self.spool, f'{num}.chunk'),
+                          'a') as file:
+                    if self.chunk_sizes[num]:
+                        file.write(',')
+                    file.write(','.join(chunk))
+                self.chunk_sizes[num] += len(chunk)
+                chunk.clear()
+        self.buffered = 0
+
+    def write_chunks(self,
+                     file: TextIO,
+                     indent: str = None,
+                     ) -> None:
+        """
+        Write the chunks of the lazy datasets, copied from their files.
+
+        Args:
+            file: the output text file.
+            indent: the indentation of the chunks in 'pretty' XML, or
+                None for 'plain' XML or HTML.
+
+        Returns: None
+
+        """
+        if not self.lazy:
+            return
+        self.spool_chunks()
+        try:
+            for num, size in enumerate(self.chunk_sizes):
+                if indent is not None:
+                    file.write(indent)
+                    if not size:  # Empty-element tag, as write_pretty
+                        file.write(f'<chunk dataset="{num}"/>\n')
+                        continue
+                file.write(f'<chunk dataset="{num}">')
+                if size:
+                    with open(os.path.join(self.spool, f'{num}.chunk'),
+                              'r') as chunk_file:
+                        shutil.copyfileobj(chunk_file, file)
+                file.write('</chunk>' if indent is None else '</chunk>\n')
+        finally:
+            shutil.rmtree(self.spool, ignore_errors=True)
+            self.spool = None
+
+    def write_nodes(self,
+                    file: TextIO,
+                    nodes: KronaNodes,
+                    method: str = 'xml',
+                    ) -> None:
+        """
+        Write a stream of Krona nodes as they come, in constant memory.
+
+        Every node is serialized by ETree on its own (without subnodes)
+        and written but for its end tag, which is written once all its
+        subnodes are done, so the output is just the one of serializing
+        the nodes populated in the tree. The files with branches already
+        serialized (with the same method) are just copied.
+
+        Args:
+            file: the output text file.
+            nodes: the stream of nodes, in document order.
+            method: the ETree serialization method ('xml' or 'html').
+
+        Returns: None
+
+        """
+        end_tag: str = '</node>'
+        for node in nodes:
+            if node is None:
+                file.write(end_tag)
+            elif isinstance(node, str):
+                with open(node, 'r') as branch_file:
+                    shutil.copyfileobj(branch_file, file)
+            else:
+                file.write(ETree.tostring(self.node(*node),
+                                          encoding='unicode',
+                                          method=method,
+                                          short_empty_elements=False,
+                                          )[:-len(end_tag)])
+
+    def write_stream(self,
+                     file: TextIO,
+                     root: Elm,
+                     nodes: KronaNodes,
+                     method: str = 'xml',
+                     ) -> None:
+        """Write the element with the stream of nodes inside krona."""
+        document: str = ETree.tostring(root,
+                                       encoding='unicode',
+                                       method=method,
+                                       short_empty_elements=False,
+                                       )
+        split: int = document.rfind('</krona>')  # Nodes go last in krona
+        file.write(document[:split])
+        self.write_nodes(file, nodes, method)
+        self.write_chunks(file)
+        file.write(document[split:])
+
+    def write_pretty_stream(self,
+                            file: TextIO,
+                            root: Elm,
+                            nodes: KronaNodes,
+                            ) -> None:
+        """Write the element in 'pretty' XML with the stream of nodes."""
+        output: io.StringIO = io.StringIO()
+        self.write_pretty(output, root)
+        document: str = output.getvalue()
+        split: int = document.rfind('</krona>')  # Nodes go last in krona
+        line: int = document.rfind('\n', 0, split) + 1
+        indent: str = document[line:split] + PRETTY_INDENT
+        file.write(document[:line])
+        self.write_pretty_nodes(file, nodes, indent)
+        self.write_chunks(file, indent)
+        file.write(document[line:])
+
+    def write_pretty_nodes(self,
+                           file: TextIO,
+                           nodes: KronaNodes,
+                           indent: str = '',
+                           ) -> None:
+        """
+        Write a stream of Krona nodes in 'pretty' XML as they come.
+
+        A node is written once the next one is known, as it is to be
+        left open if it has subnodes. The files of branches already
+        serialized are not supported in this layout.
+
+        Args:
+            file: the output text file.
+            nodes: the stream of nodes, in document order.
+            indent: the indentation of the nodes of the first level.
+
+        Returns: None
+
+        """
+        pending: Optional[Elm] = None  # Node waiting to know of subnodes
+        for node in nodes:
+            if node is None:
+                if pending is None:
+                    indent = indent[:-len(PRETTY_INDENT)]
+                    file.write(f'{indent}</node>\n')
+                else:
+                    self.write_pretty(file, pending, indent)
+                    pending = None
+            else:
+                if pending is not None:
+                    self.write_pretty(file, pending, indent, end=False)
+                    indent += PRETTY_INDENT
+                pending = self.node(*node)
+        if pending is not None:
+            self.write_pretty(file, pending, indent)
+
     @staticmethod
-    def to_pretty_string(element: Elm):
+    def write_pretty(file: TextIO,
+                     element: Elm,
+                     indent: str = '',
+                     end: bool = True,
+                     ) -> None:
+        """
+        Write the element in 'pretty' XML in a single pass.
+
+        The layout is the one of the minidom pretty-printer (with two
+        spaces of indentation), but the text and the attributes are
+        not escaped, to keep them human readable.
+
+        Args:
+            file: the output text file.
+            element: the element to be written with its subelements.
+            indent: the indentation of the element.
+            end: if False, the end tag is not written, so that more
+                subelements can follow.
+
+        Returns: None
+
+        """
+        file.write(f'{indent}<{element.tag}')
+        attributes = element.items()
+        if SORTED_ATTRIBUTES:
+            attributes = sorted(attributes)
+        for key, value in attributes:
+            file.write(f' {key}="{value}"')
+        if end and not len(element):
+            if element.text:
+                file.write(f'>{element.text}</{element.tag}>\n')
+            else:
+                file.write('/>\n')
+            return
+        file.write('>\n')
+        inner: str = indent + PRETTY_INDENT
+        if element.text:
+            file.write(f'{inner}{element.text}\n')
+        for subelement in element:
+            KronaTree.write_pretty(file, subelement, inner)
+            if subelement.tail:
+                file.write(f'{inner}{subelement.tail}\n')
+        if end:
+            file.write(f'{indent}</{element.tag}>\n')
+
+    @staticmethod
+    def to_pretty_string(element: Elm) -> str:
         """Return a pretty-printed XML string for the Element."""
-        raw_string = ETree.tostring(element,
-                                    encoding='unicode',
-                                    method='xml',
-                                    short_empty_elements=False,
-                                    )
-        re_parsed = minidom.parseString(raw_string)
-        pretty = re_parsed.toprettyxml(indent='  ')
-        pretty = html.unescape(pretty)
-        return pretty.split('\n', 1)[-1]  # Remove the XML 1.0 tag
+        output: io.StringIO = io.StringIO()
+        KronaTree.write_pretty(output, element)
+        return output.getvalue()
 
     def __init__(self,
                  samples: List[Sample],
@@ -118,6 +397,9 @@ class KronaTree(ETree.ElementTree):
                  min_score: float = 0.0,
                  max_score: float = 1.0,
                  scoring: Scoring = Scoring.SHEL,
+                 compact: bool = False,
+                 lazy: bool = False,
+                 tmpdir: str = None,
                  ) -> None:
         """
         Args:
@@ -125,6 +407,14 @@ class KronaTree(ETree.ElementTree):
             num_raw_samples: Number of raw samples (not from cross-analysis)
             min_score: minimum expected score
             max_score: maximum expected score
+            compact: use the compact encoding of the nodes (understood
+                by the krona.js of Recentrifuge, not by ktImportXML)
+            lazy: keep the unassigned and score values of every dataset
+                apart, in a chunk to be decoded by krona.js just when
+                the dataset is selected (implies compact); the nodes
+                are to be written just once, in document order
+            tmpdir: directory for the temporary files of the chunks of
+                lazy datasets (the default one of the system if None)
         """
         # Type declaration
         self.krona: Elm
@@ -132,6 +422,16 @@ class KronaTree(ETree.ElementTree):
         self.attributes: Elm
         self.samples: List[Sample]
         self.datasets: Elm
+        self.compact: bool = compact or lazy
+        self.ranks: Dict[str, int] = {}
+        self.lazy: bool = lazy
+        self.chunks: List[List[str]] = [[] for _ in samples]
+        self.chunk_nodes: List[int] = [0] * len(samples)  # Last in chunk
+        self.chunk_sizes: List[int] = [0] * len(samples)  # Values spooled
+        self.buffered: int = 0  # Values in the chunks kept in memory
+        self.tmpdir: Optional[str] = tmpdir
+        self.spool: Optional[str] = None  # Directory with the chunk files
+        self.num_nodes: int = 0
 
         # Dummy dict if stats not provided
         if stats is None:
@@ -140,6 +440,8 @@ class KronaTree(ETree.ElementTree):
         # Set root of KronaTree
         self.krona = ETree.Element('krona',  # type: ignore
                                    attrib={'collapse': 'true', 'key': 'true'})
+        if lazy:
+            self.krona.set('lazy', 'true')
 
         # Set attributes
         self.attributes = ETree.SubElement(self.krona, 'attributes',
@@ -198,6 +500,13 @@ class KronaTree(ETree.ElementTree):
                                'default': 'true'},
                               ' ')  # Krona: Avoid empty-element tag
 
+        # Set dictionary of ranks for the compact encoding of the nodes
+        if self.compact:
+            ranks: Elm = self.sub(self.krona, 'ranks')
+            for num, rank in enumerate(Rank):
+                self.ranks[rank.name.lower()] = num
+                self.sub(ranks, 'rank', None, rank.name.lower())
+
         super(KronaTree, self).__init__(self.krona)
 
     def __repr__(self):
@@ -206,6 +515,7 @@ class KronaTree(ETree.ElementTree):
     def tofile(self,
                filename: Filename,
                pretty: bool = False,
+               nodes: KronaNodes = None,
                ) -> None:
         """
         Write KronaTree in 'plain' or 'pretty' XML.
@@ -217,24 +527,22 @@ class KronaTree(ETree.ElementTree):
                 only because it uses a lot more of space and also has
                 empty tags which are currently not supported by Krona)
                 and machine readable for False (default, saves space).
+            nodes: optional stream of nodes to be written after the
+                ones already in the tree, without keeping them.
 
         Returns: None
 
         """
         with open(filename, 'w') as xml_file:
             if pretty:
-                xml_file.write(self.to_pretty_string(self.krona))
+                self.write_pretty_stream(xml_file, self.krona, nodes or ())
             else:
-                self.write(xml_file,
-                           encoding='unicode',
-                           xml_declaration=False,
-                           method='xml',
-                           short_empty_elements=False,
-                           )
+                self.write_stream(xml_file, self.krona, nodes or (), 'xml')
 
     def tohtml(self,
                filename: Filename,
                pretty: bool = False,
+               nodes: KronaNodes = None,
                ) -> None:
         """
         Write Krona HTML.
@@ -246,68 +554,94 @@ class KronaTree(ETree.ElementTree):
                 only because it uses a lot more of space and also has
                 empty tags which are currently not supported by Krona)
                 and machine readable for False (default, saves space).
+            nodes: optional stream of nodes to be written after the
+                ones already in the tree, without keeping them.
 
         Returns: None
 
         """
-        # Read aux files
-        path = os.path.dirname(os.path.realpath(__file__))
-        with open(path + '/img/hidden.uri', 'r') as file:
-            hidden_image = file.read()
-        with open(path + '/img/loading.uri', 'r') as file:
-            loading_image = file.read()
-        with open(path + '/img/favicon.uri', 'r') as file:
-            favicon = file.read()
-        with open(path + '/img/logo-mini.uri', 'r') as file:
-            logo = file.read()
-        with open(f'{path}/{JSLIB}', 'r') as file:
-            script = file.read()
+        with open(filename, 'w') as html_file:
+            if pretty:
+                html_root, div = self.html_skeleton()
+                div.append(self.krona)  # Include specific XML from samples
+                html_file.write(HTML_DOCTYPE)
+                self.write_pretty_stream(html_file, html_root, nodes or ())
+            else:
+                prefix, suffix = self.html_template()
+                html_file.write(prefix)
+                self.write_stream(html_file, self.krona, nodes or (), 'html')
+                html_file.write(suffix)
 
+    @staticmethod
+    def assets() -> Dict[str, str]:
+        """Get the static assets of the HTML, read once per process."""
+        if not _ASSETS:
+            path = os.path.dirname(os.path.realpath(__file__))
+            for asset, asset_file in [('hidden', 'img/hidden.uri'),
+                                      ('loading', 'img/loading.uri'),
+                                      ('favicon', 'img/favicon.uri'),
+                                      ('logo', 'img/logo-mini.uri'),
+                                      ('script', JSLIB)]:
+                with open(os.path.join(path, asset_file), 'r') as file:
+                    _ASSETS[asset] = file.read()
+        return _ASSETS
+
+    @classmethod
+    def html_skeleton(cls) -> Tuple[Elm, Elm]:
+        """Build the HTML doc and return its root and the data div."""
+        assets: Dict[str, str] = cls.assets()
         # Set root of HTML doc
         html_root = ETree.Element(  # type: ignore
             'html', attrib={'xmlns': 'http://www.w3.org/1999/xhtml',
                             'xml:lang': 'en',
                             'lang': 'en'})
         # Prepare HTML file
-        head = self.sub(html_root, 'head')
-        self.sub(head, 'meta', {'charset': 'utf-8'})
-        self.sub(head, 'link', {'rel': 'shortcut icon',
-                                'href': favicon})
-        self.sub(head, 'link', {'rel': 'stylesheet',
-                                'href': 'https://fonts.googleapis.com/css?family=Ubuntu'})
-        self.sub(head, 'script', {'id': 'notfound'},
-                 'window.onload=function(){document.body.innerHTML=""}')
-        self.sub(head, 'script',
-                 {'language': 'javascript', 'type': 'text/javascript'},
-                 script)  # Include javascript
-        body = self.sub(html_root, 'body')
-        self.sub(body, 'img', {'id': 'hiddenImage',
-                               'src': hidden_image,
-                               'style': 'display:none'})
-        self.sub(body, 'img', {'id': 'loadingImage',
-                               'src': loading_image,
-                               'style': 'display:none'})
-        self.sub(body, 'img', {'id': 'logo',
-                               'src': logo,
-                               'style': 'display:none'})
-        self.sub(body, 'noscript', None,
-                 'Javascript must be enabled to view this page.')
-
-        div = self.sub(body, 'div', {'style': 'display:none'})
-        div.append(self.krona)  # Include specific XML from samples
-        # Write the HTML file
-        with open(filename, 'w') as html_file:
-            html_file.write(
-                '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n')  # pylint: disable=line-too-long
-            if pretty:
-                html_file.write(self.to_pretty_string(html_root))
-            else:
-                html_file.write(ETree.tostring(html_root,
-                                               encoding='unicode',
-                                               method='html',
-                                               short_empty_elements=False,
-                                               )
-                                )
+        head = cls.sub(html_root, 'head')
+        cls.sub(head, 'meta', {'charset': 'utf-8'})
+        cls.sub(head, 'link', {'rel': 'shortcut icon',
+                               'href': assets['favicon']})
+        cls.sub(head, 'link', {'rel': 'stylesheet',
+                               'href': 'https://fonts.googleapis.com/css?family=Ubuntu'})
+        cls.sub(head, 'script', {'id': 'notfound'},
+                'window.onload=function(){document.body.innerHTML=""}')
+        cls.sub(head, 'script',
+                {'language': 'javascript', 'type': 'text/javascript'},
+                assets['script'])  # Include javascript
+        body = cls.sub(html_root, 'body')
+        cls.sub(body, 'img', {'id': 'hiddenImage',
+                              'src': assets['hidden'],
+                              'style': 'display:none'})
+        cls.sub(body, 'img', {'id': 'loadingImage',
+                              'src': assets['loading'],
+                              'style': 'display:none'})
+        cls.sub(body, 'img', {'id': 'logo',
+                              'src': assets['logo'],
+                              'style': 'display:none'})
+        cls.sub(body, 'noscript', None,
+                'Javascript must be enabled to view this page.')
+        div = cls.sub(body, 'div', {'style': 'display:none'})
+        return html_root, div
+
+    @classmethod
+    def html_template(cls) -> Tuple[str, str]:
+        """
+        Get the HTML doc before and after the data, built once per process.
+
+        Returns: Tuple with the prefix (including the DOCTYPE) and the
+            suffix of the HTML to be written around the krona element.
+
+        """
+        if not _HTML_TEMPLATE:
+            html_root, _ = cls.html_skeleton()
+            document: str = HTML_DOCTYPE + ETree.tostring(
+                html_root,
+                encoding='unicode',
+                method='html',
+                short_empty_elements=False,
+            )
+            split: int = document.rfind('</div>')  # Data div goes last
+            _HTML_TEMPLATE.extend([document[:split], document[split:]])
+        return _HTML_TEMPLATE[0], _HTML_TEMPLATE[1]
 
 
 def krona_from_xml(xmlfile: Filename,
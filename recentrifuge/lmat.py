@@ -69,28 +69,18 @@ class Match(Enum):
         return f'{self.name}'
 
 
-def read_lmat_output(output_file: Filename,
-                     scoring: Scoring = Scoring.LMAT,
-                     minscore: Score = None,
-                     ) -> Tuple[str, SampleStats,
-                                Counter[TaxId], Dict[TaxId, Score]]:
+def get_lmat_output_files(output_file: Filename
+                          ) -> Tuple[Filename, List[Filename]]:
     """
-    Read LMAT output (iterate over all the output files)
+    Get the LMAT output files (shards) of a sample
 
     Args:
-        output_file: output file name (prefix)
-        scoring: type of scoring to be applied (see Scoring class)
-        minscore: minimum confidence level for the classification
+        output_file: output file name (prefix) or directory name
 
     Returns:
-        log string, abundances counter, scores dict
+        directory name, list of the output files (shards) names
 
     """
-    output: io.StringIO = io.StringIO(newline='')
-    all_scores: Dict[TaxId, List[Score]] = {}
-    all_length: Dict[TaxId, List[int]] = {}
-    nt_read: int = 0
-    matchings: Counter[Match] = Counter()
     output_files: List[Filename] = []
     # Select files to process depending on if the output files are explicitly
     #  given or directory name is provided (all the output files there)
@@ -109,6 +99,41 @@ def read_lmat_output(output_file: Filename,
     if not output_files:
         raise Exception(
             f'\n\033[91mERROR!\033[0m Cannot read from "{output_file}"')
+    return Filename(dirname), output_files
+
+
+def get_lmat_output_size(output_file: Filename) -> int:
+    """Get the total size in bytes of the LMAT output files of a sample"""
+    dirname, output_files = get_lmat_output_files(output_file)
+    return sum(os.stat(os.path.join(dirname, output_name)).st_size
+               for output_name in output_files)
+
+
+def read_lmat_output(output_file: Filename,
+                     scoring: Scoring = Scoring.LMAT,
+                     minscore: Score = None,
+                     ) -> Tuple[str, SampleStats,
+                                Counter[TaxId], Dict[TaxId, Score]]:
+    """
+    Read LMAT output (iterate over all the output files)
+
+    Args:
+        output_file: output file name (prefix)
+        scoring: type of scoring to be applied (see Scoring class)
+        minscore: minimum confidence level for the classification
+
+    Returns:
+        log string, abundances counter, scores dict
+
+    """
+    output: io.StringIO = io.StringIO(newline='')
+    all_scores: Dict[TaxId, List[Score]] = {}
+    all_length: Dict[TaxId, List[int]] = {}
+    nt_read: int = 0
+    matchings: Counter[Match] = Counter()
+    dirname: Filename
+    output_files: List[Filename]
+    dirname, output_files = get_lmat_output_files(output_file)
     # Read LMAT output files
     for output_name in output_files:
         path: Filename = Filename(os.path.join(dirname, output_name))
@@ -0,0 +1,127 @@
+"""
+Classes to generate several outputs from a single walk of the results tree.
+
+"""
+
+import queue
+import threading
+from typing import List, Dict, Iterator, Optional, Any
+
+from recentrifuge.config import Filename, TaxId
+from recentrifuge.config import OUTPUT_BATCH_NODES, OUTPUT_QUEUE_BATCHES
+from recentrifuge.krona import KronaTree, KronaNodes
+
+# End of the events sent to the thread of the Krona output
+_END: Any = object()
+
+
+class Output(object):
+    """Base class of the outputs fed with the nodes of a tree walk.
+
+    The tree is walked once (see MultiTree.walk), depth-first, and all
+    the outputs are visited at the same time: open_node() is called
+    when a node is reached (with its rank and name already looked up
+    in the taxonomy) and close_node() when all the nodes under it are
+    done. The outputs are opened before the walk and closed after it.
+    """
+
+    def open(self) -> None:
+        """Prepare the output for the walk"""
+
+    def open_node(self, tid: TaxId, node: Any, rank: str, name: str) -> None:
+        """Visit a node, given with its taxid, rank and name"""
+
+    def close_node(self) -> None:
+        """Leave the last node opened"""
+
+    def close(self) -> None:
+        """Finish the output after the walk"""
+
+
+class KronaOutput(Output):
+    """Krona HTML plot, with the nodes streamed to the file by a thread.
+
+    The writer of the KronaTree pulls the nodes, so it runs in its own
+    thread, fed with the events of the walk in batches through a
+    bounded queue (so the memory is kept constant if the thread is
+    slower than the walk). Every open event is a tuple with the taxid,
+    node, rank and name, and every close event is None. The branches
+    of the tree already written to files (in parallel) are given
+    instead of their nodes. Any error in the thread is raised again
+    when the output is closed.
+    """
+
+    def __init__(self,
+                 krona: KronaTree,
+                 htmlfile: Filename,
+                 branch_files: Dict[TaxId, Filename] = None,
+                 ) -> None:
+        """
+        Args:
+            krona: KronaTree with the samples data.
+            htmlfile: Name of the HTML output file.
+            branch_files: Files with the nodes of some branches already
+                serialized, to be copied instead of their nodes.
+        """
+        self.krona: KronaTree = krona
+        self.htmlfile: Filename = htmlfile
+        self.branch_files: Dict[TaxId, Filename] = branch_files or {}
+        self.queue: queue.Queue = queue.Queue(OUTPUT_QUEUE_BATCHES)
+        self.batch: List[Optional[tuple]] = []
+        self.thread: threading.Thread = threading.Thread(
+            target=self.run, daemon=True)
+        self.error: Optional[BaseException] = None
+        self.ended: bool = False  # True once the thread got the _END
+
+    def open(self) -> None:
+        self.thread.start()
+
+    def open_node(self, tid: TaxId, node: Any, rank: str, name: str) -> None:
+        self.batch.append((tid, node, rank, name))
+        if len(self.batch) >= OUTPUT_BATCH_NODES:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def close_node(self) -> None:
+        self.batch.append(None)
+
+    def close(self) -> None:
+        self.queue.put(self.batch)
+        self.queue.put(_END)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def events(self) -> Iterator[Optional[tuple]]:
+        """Generate the events of the walk as they arrive to the queue"""
+        while True:
+            batch = self.queue.get()
+            if batch is _END:
+                self.ended = True
+                return
+            yield from batch
+
+    def nodes(self) -> KronaNodes:
+        """Generate the Krona nodes from the events of the walk"""
+        skipped: int = 0  # Depth inside a branch already in a file
+        for event in self.events():
+            if skipped:
+                skipped += -1 if event is None else 1
+            elif event is None:
+                yield None
+            elif event[0] in self.branch_files:
+                yield self.branch_files[event[0]]  # Includes its closing
+                skipped = 1
+            else:
+                tid, node, rank, name = event
+                yield node.krona_values(tid, rank, name)
+
+    def run(self) -> None:
+        """Write the HTML file in the thread, keeping any error"""
+        try:
+            self.krona.tohtml(self.htmlfile, pretty=False,
+                              nodes=self.nodes())
+        except BaseException as error:  # pylint: disable=broad-except
+            self.error = error
+            while not self.ended:  # Do not block the walk
+                self.ended = self.queue.get() is _END
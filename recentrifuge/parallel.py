@@ -0,0 +1,273 @@
+"""
+Classes and functions related with the parallel processing of tasks.
+
+"""
+
+import gc
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import AsyncResult, Pool
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+from recentrifuge.config import gray, blue
+
+# State shared with the workers of the pool, inherited through fork and
+#   updated from the files published by the Executor (one per generation)
+_SHARED: Dict[str, Any] = {}
+_STATUS: Dict[str, Any] = {'generation': 0, 'path': None}
+
+
+def _init_worker(kwargs: Dict[str, Any], path: str) -> None:
+    """Initializer of the workers: set the shared state"""
+    _SHARED.clear()
+    _SHARED.update(kwargs)
+    _STATUS['generation'] = 0
+    _STATUS['path'] = path
+
+
+def _update_worker(generation: int) -> None:
+    """Load in the worker the updates of the shared state, if any"""
+    if _STATUS['generation'] >= generation:
+        return
+    while _STATUS['generation'] < generation:
+        _STATUS['generation'] += 1
+        with open(os.path.join(_STATUS['path'],
+                               f'{_STATUS["generation"]}.pickle'),
+                  'rb') as file:
+            _SHARED.update(pickle.load(file))
+    if hasattr(gc, 'freeze'):
+        gc.freeze()  # Keep the GC off the (big and long-lived) shared state
+
+
+def prepare_fork() -> None:
+    """
+    Prepare the objects of the parent process to be shared by fork.
+
+    After forking, the pages of the parent are shared copy-on-write,
+    but every run of the cyclic garbage collector in a worker writes
+    the GC headers of all the tracked objects, so the pages with the
+    taxonomy and the sample data end up copied in every worker. Here
+    the garbage is collected and, if available (Python 3.7+), all the
+    surviving objects are moved to the permanent generation, which is
+    ignored by the collector.
+
+    """
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def mem_usage() -> Dict[str, int]:
+    """
+    Get the memory usage of the current process.
+
+    Returns:
+        Dict with the resident set size ('Rss'), proportional set size
+        ('Pss', that divides the shared pages among the processes
+        sharing them) and private dirty memory ('Private_Dirty'), all
+        in kB, as reported by the Linux kernel. Empty if unavailable.
+
+    """
+    usage: Dict[str, int] = {}
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as file:
+            for line in file:
+                field, *value = line.split()
+                if field[:-1] in ('Rss', 'Pss', 'Private_Dirty'):
+                    usage[field[:-1]] = int(value[0])
+    except OSError:
+        pass
+    return usage
+
+
+def call(generation: int, func: Callable, *args) -> Tuple[Any, float]:
+    """
+    Call a function inside a worker of an Executor.
+
+    Just the function (by reference) and the positional arguments,
+    typically a key like a sample or a rank, are sent to the worker.
+    The keyword arguments are taken from the shared state, once it
+    is updated to the generation of the task. In debug mode, the
+    memory usage of the worker is printed after the call.
+
+    Args:
+        generation: Generation of the shared state for the task.
+        func: Function to be called.
+        *args: Positional arguments for the function.
+
+    Returns: The result of the function call and its elapsed time.
+
+    """
+    start_time: float = time.perf_counter()
+    _update_worker(generation)
+    result: Any = func(*args, **_SHARED)
+    if _SHARED.get('debug'):
+        usage: Dict[str, int] = mem_usage()
+        if usage:
+            print(gray(f'Worker {os.getpid()} memory after {args[0]}:'),
+                  ', '.join(f'{field}=' + blue(f'{value / 1024:.1f}')
+                            + gray(' MiB') for field, value in usage.items()))
+            sys.stdout.flush()
+    return result, time.perf_counter() - start_time
+
+
+class Executor(object):
+    """Persistent pool of workers shared by all the stages of a run.
+
+    The workers are forked once, with the keyword arguments given at
+    creation (typically with the taxonomy) already attached, and they
+    keep warm while the tasks of the different stages are submitted.
+    The shared state is extended between stages with share(): each
+    update is serialized just once to a file, and every worker loads
+    it (at most once) before its first task of the new generation.
+    For the big updates (like the data of all the samples) refork()
+    forks the workers again instead, so the new state is also shared
+    copy-on-write. Without processes, the tasks are just called
+    sequentially.
+    """
+
+    def __init__(self,
+                 kwargs: Dict[str, Any],
+                 processes: int = None,
+                 ) -> None:
+        """
+        Args:
+            kwargs: Keyword arguments to be shared with all the tasks.
+            processes: Number of workers of the pool; if it is None
+                or 0, the tasks are run sequentially.
+        """
+        self.kwargs: Dict[str, Any] = kwargs
+        self.processes: int = processes
+        self.generation: int = 0
+        self.path: str = None
+        self.pool: Pool = None
+        self.efficiency: float = None  # Parallel efficiency of last map
+        if processes:
+            self.path = tempfile.mkdtemp(prefix='rcf_')
+            self._fork()
+
+    def __enter__(self) -> 'Executor':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _fork(self) -> None:
+        """Fork the workers with the current shared state"""
+        prepare_fork()
+        mpctx = mp.get_context('fork')  # Important for OSX&Win
+        self.pool = mpctx.Pool(processes=self.processes,
+                               initializer=_init_worker,
+                               initargs=(self.kwargs, self.path))
+        self.generation = 0
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()  # Workers are already forked
+
+    def share(self, **kwargs) -> None:
+        """
+        Update the shared state for the tasks submitted hereafter.
+
+        The update is pickled and every worker loads a private copy of
+        it, so this costs (processes + 1) times its size in memory: it
+        is intended for small updates. Use refork() for the big ones.
+
+        """
+        self.kwargs.update(kwargs)
+        if self.pool is not None:
+            self.generation += 1
+            with open(os.path.join(self.path, f'{self.generation}.pickle'),
+                      'wb') as file:
+                pickle.dump(kwargs, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def refork(self, **kwargs) -> None:
+        """
+        Update the shared state and fork the workers again with it.
+
+        The (idle) workers are replaced by new ones forked from the
+        current process, so the whole shared state, including this
+        update, is shared copy-on-write with the parent instead of
+        being copied into every worker.
+
+        """
+        self.kwargs.update(kwargs)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self._fork()
+
+    def map(self,
+            func: Callable,
+            *iterables,
+            weights: List[int] = None,
+            max_weight: int = None,
+            ) -> List[Any]:
+        """
+        Run func for the items of the iterables and wait for the results.
+
+        With weights, the tasks are submitted by decreasing weight
+        (longest processing time first), so a big task submitted
+        last does not determine the makespan. The results are always
+        returned in the order of the iterables.
+
+        Args:
+            func: Function to be called (must be defined at module
+                level, as it is sent by reference).
+            *iterables: Positional arguments for the function.
+            weights: Optional estimation of the cost of each task.
+            max_weight: If given with weights, the tasks running at
+                the same time cannot exceed this total weight (but a
+                task is always run if no other is running).
+
+        Returns: List with the results.
+
+        """
+        start_time: float = time.perf_counter()
+        tasks: List[Tuple] = list(zip(*iterables))
+        results: List[Any] = [None] * len(tasks)
+        busy_time: float = 0
+        if not tasks:
+            return results
+        if self.pool is None:
+            for num, args in enumerate(tasks):
+                results[num] = func(*args, **self.kwargs)
+            self.efficiency = 1.0
+            return results
+        order: List[int] = list(range(len(tasks)))
+        if weights is not None:
+            order.sort(key=lambda num: weights[num], reverse=True)
+        else:
+            max_weight = None
+        done: queue.Queue = queue.Queue()
+        running: Set[int] = set()
+        async_results: Dict[int, AsyncResult] = {}
+        for num in order:
+            while running and max_weight is not None and (
+                    sum(weights[task] for task in running) + weights[num]
+                    > max_weight):
+                running.remove(done.get())  # Wait for a task to finish
+            running.add(num)
+            async_results[num] = self.pool.apply_async(
+                call, (self.generation, func) + tasks[num],
+                callback=lambda _, task=num: done.put(task),
+                error_callback=lambda _, task=num: done.put(task))
+        for num, async_result in async_results.items():
+            results[num], elapsed = async_result.get()
+            busy_time += elapsed
+        self.efficiency = busy_time / (
+            (time.perf_counter() - start_time)
+            * min(self.processes, len(tasks)))
+        return results
+
+    def close(self) -> None:
+        """Stop the workers and remove the files of the shared state"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,261 @@
+"""
+Classes and functions to write the results as tables (Excel and others).
+
+"""
+
+import math
+from typing import List, Dict, Tuple, Any, TextIO
+
+import numpy as np
+
+from recentrifuge.config import Filename, Sample, SampleStats, TaxId
+from recentrifuge.krona import COUNT, UNASSIGNED, SCORE
+from recentrifuge.outputs import Output
+from recentrifuge.trees import MultiTree
+
+# Format of the header and index cells (as written by pandas)
+HEADER_FORMAT: Dict[str, Any] = {'bold': True, 'border': 1,
+                                 'align': 'center', 'valign': 'top'}
+# Workbook options to write the rows and discard them (in constant memory)
+WORKBOOK_OPTIONS: Dict[str, Any] = {'constant_memory': True}
+# Number of rows of the TSV table buffered before writing them to the file
+TSV_CHUNK_ROWS: int = 4096
+
+
+def write_cell(sheet, row: int, col: int, value: Any,
+               cell_format=None) -> None:
+    """Write a cell of a worksheet, leaving it empty for None or NaN"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        value = ''
+    sheet.write(row, col, value, cell_format)
+
+
+def write_stats(workbook,
+                sheet_name: str,
+                raw_samples: List[Sample],
+                stats: Dict[Sample, SampleStats],
+                ) -> None:
+    """
+    Write a worksheet with the basic statistics of the raw samples.
+
+    Args:
+        workbook: XlsxWriter Workbook.
+        sheet_name: Name of the new worksheet.
+        raw_samples: List of raw samples, one per column.
+        stats: Statistics of the samples.
+
+    Returns: None
+
+    """
+    sheet = workbook.add_worksheet(sheet_name)
+    header = workbook.add_format(HEADER_FORMAT)
+    columns: List[Dict[str, Any]] = [stats[raw].to_dict()
+                                     for raw in raw_samples]
+    for col, raw in enumerate(raw_samples, 1):
+        sheet.write(0, col, raw, header)
+    for row, stat in enumerate(columns[0] if columns else [], 1):
+        sheet.write(row, 0, stat, header)
+        for col, column in enumerate(columns, 1):
+            write_cell(sheet, row, col, column[stat])
+
+
+def full_header(samples: List[Sample]) -> List[str]:
+    """Get the flat header of the full table: TaxId, sample:stat..."""
+    header: List[str] = ['TaxId']
+    for sample in samples:
+        header.extend(f'{sample}:{stat}'
+                      for stat in [COUNT, UNASSIGNED, SCORE])
+    header.extend(['Rank', 'Name'])
+    return header
+
+
+class ExcelOutput(Output):
+    """Base class of the Excel worksheets written in a walk of the tree.
+
+    The rows are written as the nodes are visited, so the workbook is
+    expected in constant memory mode; it is closed with the output.
+    """
+
+    def __init__(self, workbook) -> None:
+        """
+        Args:
+            workbook: XlsxWriter Workbook (in constant memory mode).
+        """
+        self.workbook = workbook
+        self.header = workbook.add_format(HEADER_FORMAT)
+        self.row: int = 0
+
+    def close(self) -> None:
+        self.workbook.close()
+
+
+class FullExcel(ExcelOutput):
+    """Worksheet with all the data of the samples for every taxon.
+
+    The layout is the one of a DataFrame with the samples and their
+    stats (count, unassigned and score) as the two levels of the
+    columns, followed by the rank and the name of the taxon.
+    """
+
+    def __init__(self, workbook, sheet_name: str,
+                 samples: List[Sample]) -> None:
+        """
+        Args:
+            workbook: XlsxWriter Workbook (in constant memory mode).
+            sheet_name: Name of the new worksheet.
+            samples: List of samples in the MultiTree.
+        """
+        super().__init__(workbook)
+        self.sheet = workbook.add_worksheet(sheet_name)
+        stats: List[str] = [COUNT, UNASSIGNED, SCORE]
+        num_samples: int = len(samples)
+        self.sheet.write(0, 0, 'Samples', self.header)
+        for num, sample in enumerate(samples):
+            self.sheet.merge_range(0, 1 + num * 3, 0, 3 + num * 3,
+                                   sample, self.header)
+        self.sheet.merge_range(0, 1 + num_samples * 3, 0, 2 + num_samples * 3,
+                               'Details', self.header)
+        self.sheet.write(1, 0, 'Stats', self.header)
+        for col, stat in enumerate(stats * num_samples + ['Rank', 'Name'], 1):
+            self.sheet.write(1, col, stat, self.header)
+        self.sheet.write(2, 0, 'TaxId', self.header)
+        self.row = 3
+
+    def open_node(self, tid: TaxId, node: MultiTree,
+                  rank: str, name: str) -> None:
+        self.sheet.write(self.row, 0, tid, self.header)
+        col: int = 1
+        for acc, count, score in zip(node.accs, node.counts, node.score):
+            write_cell(self.sheet, self.row, col, acc)
+            write_cell(self.sheet, self.row, col + 1, count)
+            write_cell(self.sheet, self.row, col + 2, score)
+            col += 3
+        self.sheet.write(self.row, col, rank)
+        self.sheet.write(self.row, col + 1, name)
+        self.row += 1
+
+
+class CountsExcel(ExcelOutput):
+    """Worksheets with the counts of some samples for every taxon.
+
+    All the worksheets are written at the same time, row by row: the
+    counts of every node are routed to the row of each worksheet with
+    its selection of samples. In constant memory mode every worksheet
+    keeps its own row buffer, so the interleaved rows cost nothing.
+    """
+
+    def __init__(self, workbook,
+                 sheets: List[Tuple[str, List[str], List[int]]]) -> None:
+        """
+        Args:
+            workbook: XlsxWriter Workbook (in constant memory mode).
+            sheets: Name of every new worksheet, with the header of the
+                column of every sample and the indexes of the samples
+                in the MultiTree.
+        """
+        super().__init__(workbook)
+        self.sheets: List[Tuple[Any, int, List[int]]] = []
+        for sheet_name, columns, indexes in sheets:
+            sheet = workbook.add_worksheet(sheet_name)
+            first_row: int = 1
+            if not columns:  # As pandas, without columns the index goes below
+                first_row = 2
+            for col, column in enumerate(columns, 1):
+                sheet.write(0, col, column, self.header)
+            sheet.write(first_row - 1, 0, 'TaxId', self.header)
+            self.sheets.append((sheet, first_row, indexes))
+
+    def open_node(self, tid: TaxId, node: MultiTree,
+                  rank: str, name: str) -> None:
+        for sheet, first_row, indexes in self.sheets:
+            sheet.write(first_row + self.row, 0, tid, self.header)
+            for col, i in enumerate(indexes, 1):
+                write_cell(sheet, first_row + self.row, col, node.counts[i])
+        self.row += 1
+
+
+class TsvTable(Output):
+    """TSV table with all the data of the samples for every taxon.
+
+    The columns are the ones of the full Excel, with a single header
+    line, and the rows are written in chunks as the tree is walked.
+    """
+
+    def __init__(self, filename: Filename, samples: List[Sample]) -> None:
+        """
+        Args:
+            filename: Name of the TSV file.
+            samples: List of samples in the MultiTree.
+        """
+        self.filename: Filename = filename
+        self.samples: List[Sample] = samples
+        self.file: TextIO = None
+        self.rows: List[str] = []
+
+    def open(self) -> None:
+        self.file = open(self.filename, 'w')
+        self.file.write('\t'.join(full_header(self.samples)) + '\n')
+
+    def open_node(self, tid: TaxId, node: MultiTree,
+                  rank: str, name: str) -> None:
+        row: List[str] = [tid]
+        for acc, count, score in zip(node.accs, node.counts, node.score):
+            row.extend([str(acc), str(count),
+                        '' if score is None else str(score)])
+        row.extend([rank, name])
+        self.rows.append('\t'.join(row) + '\n')
+        if len(self.rows) >= TSV_CHUNK_ROWS:
+            self.file.writelines(self.rows)
+            self.rows.clear()
+
+    def close(self) -> None:
+        self.file.writelines(self.rows)
+        self.rows.clear()
+        self.file.close()
+
+
+class NpzTable(Output):
+    """NumPy archive with all the data of the samples by columns.
+
+    The archive has the same data as the full Excel, but by columns:
+    'samples' and 'TaxId', 'Rank' and 'Name' (one item per taxon) are
+    arrays of strings, while the counts, unassigned and score arrays
+    have one row per taxon and one column per sample (the NaN of the
+    score array means no score). The archive can be read with
+    numpy.load() and is not compressed, so it is fast to write and
+    to read.
+    """
+
+    def __init__(self, filename: Filename, polytree: MultiTree) -> None:
+        """
+        Args:
+            filename: Name of the npz file.
+            polytree: MultiTree to be walked (to size the arrays).
+        """
+        self.filename: Filename = filename
+        self.samples: List[Sample] = polytree.samples
+        shape = (polytree.num_nodes(), len(polytree.samples))
+        self.accs: np.ndarray = np.zeros(shape, dtype=np.int64)
+        self.counts: np.ndarray = np.zeros(shape, dtype=np.int64)
+        self.scores: np.ndarray = np.zeros(shape, dtype=np.float64)
+        self.tids: List[str] = []
+        self.ranks: List[str] = []
+        self.names: List[str] = []
+
+    def open_node(self, tid: TaxId, node: MultiTree,
+                  rank: str, name: str) -> None:
+        row: int = len(self.tids)
+        self.accs[row] = node.accs
+        self.counts[row] = node.counts
+        self.scores[row] = node.score  # The scores None are stored as NaN
+        self.tids.append(tid)
+        self.ranks.append(rank)
+        self.names.append(name)
+
+    def close(self) -> None:
+        np.savez(self.filename, samples=np.array(self.samples, dtype=str),
+                 TaxId=np.array(self.tids, dtype=str),
+                 Rank=np.array(self.ranks, dtype=str),
+                 Name=np.array(self.names, dtype=str),
+                 **{COUNT: self.accs, UNASSIGNED: self.counts,
+                    SCORE: self.scores})
@@ -5,12 +5,16 @@ TaxTree and MultiTree classes.
 
 import collections as col
 import io
-from typing import Counter, Union, Dict, List, Iterable, Tuple, Set
+from typing import Counter, Union, Dict, List, Iterable, Iterator, Tuple
+from typing import Set, Any
+
+import numpy as np
 
 from recentrifuge.config import ROOT, NO_SCORE, UnionCounter, UnionScores
 from recentrifuge.config import TaxId, Parents, Sample, Score, Scores
 from recentrifuge.krona import COUNT, UNASSIGNED, TID, RANK, SCORE
-from recentrifuge.krona import KronaTree, Elm
+from recentrifuge.krona import KronaNodes, Attrib
+from recentrifuge.outputs import Output
 from recentrifuge.rank import Rank, Ranks, TaxLevels
 from recentrifuge.shared_counter import SharedCounter
 from recentrifuge.taxonomy import Taxonomy
@@ -114,6 +118,622 @@ class SampleDataByTaxId(object):
         return NotImplemented
 
 
+class FlatTree(object):
+    """Array-backed taxonomical tree for bottom-up vectorized passes.
+
+    Nodes are stored in depth-first preorder, so the parent of a node is
+    always before it and siblings keep their order inside each level.
+    Bottom-up passes go level by level, from the deepest to the top one,
+    with NumPy operations over the indices of the parents. Scores use
+    NaN as NO_SCORE.
+    """
+    # Below this number of parents in a round, the remaining score folds
+    #   of a level are done in plain Python (rounds would be slower)
+    MIN_FOLD_ROUND: int = 32
+
+    def __init__(self,
+                 taxids: List[TaxId],
+                 parents: List[int],
+                 depths: List[int],
+                 counts: List[int],
+                 scores: List[Score],
+                 ) -> None:
+        """
+        Args:
+            taxids: List of taxids of the nodes, in preorder.
+            parents: List with the index of the parent of each node
+                (-1 for the top node).
+            depths: List with the depth of each node (0 for the top).
+            counts: List with the counts (abundance) of each node.
+            scores: List with the score of each node.
+        """
+        self.taxids: List[TaxId] = taxids
+        self.parents: np.ndarray = np.array(parents, dtype=np.intp)
+        self.counts: np.ndarray = np.array(counts, dtype=np.int64)
+        self.scores: np.ndarray = np.array(
+            [np.nan if score is NO_SCORE else score for score in scores],
+            dtype=np.float64)
+        # Indices of the nodes in each level, keeping the preorder
+        _depths: np.ndarray = np.array(depths, dtype=np.intp)
+        self.levels: List[np.ndarray] = np.split(
+            np.argsort(_depths, kind='mergesort'),
+            np.cumsum(np.bincount(_depths))[:-1])
+        # Optional data to be set by the constructors
+        self.ranks: List[Rank] = None
+        self.rank_prune: np.ndarray = None
+        self.save_pruned: np.ndarray = None
+        self.collected: np.ndarray = None
+
+    def __len__(self) -> int:
+        return len(self.taxids)
+
+    @classmethod
+    def from_taxonomy(cls,
+                      taxonomy: Taxonomy,
+                      counts: UnionCounter,
+                      scores: Union[Dict[TaxId, Score], SharedCounter],
+                      ancestors: Set[TaxId],
+                      tid: TaxId = ROOT,
+                      min_rank: Rank = None,
+                      just_min_rank: bool = False,
+                      include: Union[Tuple, Set[TaxId]] = (),
+                      exclude: Union[Tuple, Set[TaxId]] = (),
+                      ) -> 'FlatTree':
+        """
+        Build the skeleton of the tree used by TaxTree.allin1().
+
+        The conditions related with the ranks, both for assigning
+        counts and for pruning, are evaluated here once per node,
+        as they do not depend on the accumulated counts.
+
+        Args: See TaxTree.allin1()
+
+        Returns: FlatTree ready for allin1_pass()
+
+        """
+
+        def le_min_rank(rank: Rank) -> bool:
+            """Check if rank is lower or equal to min_rank"""
+            return rank is not None and rank <= min_rank
+
+        taxids: List[TaxId] = []
+        parents: List[int] = []
+        depths: List[int] = []
+        abuns: List[int] = []
+        node_scores: List[Score] = []
+        ranks: List[Rank] = []
+        parent_ranks: List[Rank] = []  # 1st rank above that is not NO_RANK
+        up_ranks: List[Rank] = []  # Parent rank for the children
+        rank_prune: List[bool] = []
+        save_pruned: List[bool] = []
+        visited: Set[TaxId] = set()
+        # Stack items are parent index, taxid and flag of included branch
+        stack: List[Tuple[int, TaxId, bool]] = [
+            (-1, tid, not include or tid in include)]
+        while stack:  # Siblings pushed in reverse order are popped in order
+            parent, taxid, included = stack.pop()
+            visited.add(taxid)
+            index: int = len(taxids)
+            rank: Rank = taxonomy.get_rank(taxid)
+            parent_rank: Rank
+            if parent < 0:
+                parent_rank = Rank.ROOT if taxid == ROOT else None
+                depths.append(0)
+                rank_prune.append(False)
+                save_pruned.append(False)
+            else:
+                parent_rank = up_ranks[parent]
+                depths.append(depths[parent] + 1)
+                # Same min_rank pruning conditions than in allin1
+                prune: bool = bool(min_rank) and (
+                    rank < min_rank or le_min_rank(ranks[parent])
+                    or le_min_rank(parent_ranks[parent]))
+                rank_prune.append(prune)
+                save_pruned.append(not just_min_rank or (prune and (
+                    ranks[parent] == min_rank
+                    or le_min_rank(parent_ranks[parent]))))
+            taxids.append(taxid)
+            parents.append(parent)
+            ranks.append(rank)
+            parent_ranks.append(parent_rank)
+            if rank is not Rank.NO_RANK or parent < 0:
+                up_ranks.append(rank)
+            else:
+                up_ranks.append(up_ranks[parent])
+            if ((not just_min_rank or le_min_rank(rank)
+                 or le_min_rank(parent_rank)) and included):
+                abuns.append(counts.get(taxid, 0))
+            else:
+                abuns.append(0)
+            node_scores.append(scores.get(taxid, NO_SCORE))
+            stack.extend((index, chld, included or chld in include)
+                         for chld in reversed(list(
+                             taxonomy.children.get(taxid, ())))
+                         if (chld in ancestors and chld not in exclude
+                             and chld not in visited))
+        flat = cls(taxids, parents, depths, abuns, node_scores)
+        flat.ranks = ranks
+        flat.rank_prune = np.array(rank_prune, dtype=np.bool_)
+        flat.save_pruned = np.array(save_pruned, dtype=np.bool_)
+        return flat
+
+    @classmethod
+    def from_sample(cls,
+                    taxonomy: Taxonomy,
+                    counts: UnionCounter = None,
+                    scores: Union[Dict[TaxId, Score], SharedCounter] = None,
+                    ancestors: Set[TaxId] = None,
+                    tid: TaxId = ROOT,
+                    min_rank: Rank = None,
+                    just_min_rank: bool = False,
+                    include: Union[Tuple, Set[TaxId]] = (),
+                    exclude: Union[Tuple, Set[TaxId]] = (),
+                    ) -> 'FlatTree':
+        """
+        Build the skeleton of the tree of a sample, as TaxTree.allin1().
+
+        Args: See TaxTree.allin1()
+
+        Returns: FlatTree ready for allin1_pass()
+
+        """
+        if not counts:
+            counts = col.Counter({ROOT: 1})
+        if not scores:
+            scores = {}
+        if min_rank is None and just_min_rank:
+            raise RuntimeError('allin1: just_min_rank without min_rank')
+        if not ancestors:
+            ancestors, _ = taxonomy.get_ancestors(counts.keys())
+        return cls.from_taxonomy(
+            taxonomy=taxonomy, counts=counts, scores=scores,
+            ancestors=ancestors, tid=tid, min_rank=min_rank,
+            just_min_rank=just_min_rank, include=include, exclude=exclude)
+
+    @classmethod
+    def from_growth(cls,
+                    taxonomy: Taxonomy,
+                    counts: UnionCounter,
+                    scores: Union[Dict[TaxId, Score], SharedCounter],
+                    ancestors: Set[TaxId],
+                    include: Union[Tuple, Set[TaxId]] = (),
+                    exclude: Union[Tuple, Set[TaxId]] = (),
+                    ) -> 'FlatTree':
+        """
+        Build the tree that TaxTree.grow() would build in an empty tree.
+
+        The top node stands for the empty TaxTree. The nodes that
+        TaxTree.get_taxa() would collect with the include and exclude
+        arguments are flagged in the collected array.
+
+        Args:
+            taxonomy: Taxonomy object.
+            counts: counter for taxids with their abundances.
+            scores: dict with the score for each taxid.
+            ancestors: set of ancestors (taxids allowed in the tree).
+            include: root taxids of the subtrees to be collected
+                (all the taxa if it is empty).
+            exclude: root taxids of the subtrees not to be collected.
+
+        Returns: FlatTree ready for prune(), subtract() and shape()
+
+        """
+        taxids: List[TaxId] = [None]
+        parents: List[int] = [-1]
+        depths: List[int] = [0]
+        abuns: List[int] = [0]
+        node_scores: List[Score] = [0]  # Default score of an empty TaxTree
+        ranks: List[Rank] = [Rank.UNCLASSIFIED]
+        collected: List[bool] = [False]
+        visited: Set[TaxId] = set()
+        # Stack items are parent index and taxid
+        stack: List[Tuple[int, TaxId]] = []
+        if ROOT in ancestors:
+            stack.append((0, ROOT))
+        while stack:  # Siblings pushed in reverse order are popped in order
+            parent, taxid = stack.pop()
+            visited.add(taxid)
+            index: int = len(taxids)
+            taxids.append(taxid)
+            parents.append(parent)
+            depths.append(depths[parent] + 1)
+            abuns.append(counts.get(taxid, 0))
+            node_scores.append(scores.get(taxid, NO_SCORE))
+            ranks.append(taxonomy.get_rank(taxid))
+            collected.append(
+                (collected[parent] or not include or taxid in include)
+                and taxid not in exclude)
+            stack.extend((index, chld)
+                         for chld in reversed(list(
+                             taxonomy.children.get(taxid, ())))
+                         if chld in ancestors and chld not in visited)
+        flat = cls(taxids, parents, depths, abuns, node_scores)
+        flat.ranks = ranks
+        flat.collected = np.array(collected, dtype=np.bool_)
+        return flat
+
+    @classmethod
+    def from_samples(cls,
+                     taxonomy: Taxonomy,
+                     counts: List[Counter[TaxId]],
+                     accs: List[Counter[TaxId]],
+                     scores: List[Dict[TaxId, Score]],
+                     include: Union[Tuple, Set[TaxId]] = (),
+                     exclude: Union[Tuple, Set[TaxId]] = (),
+                     ) -> 'FlatTree':
+        """
+        Merge the trees of several samples in a tree, as from_growth().
+
+        The nodes are the union of the taxa with accumulated counts in
+        the samples, so the taxonomy is not traversed; the counts of
+        the samples are added and the scores are merged (the last
+        sample wins). The tree is the one that from_growth() would
+        build with the merged counts and scores, but for some extra
+        nodes without counts in their subtrees (so they are neutral in
+        subtract() and shape()) and without the top container node.
+        The nodes are stored level by level and, in each level, the
+        children of a node keep their order in the taxonomy.
+
+        Args:
+            taxonomy: Taxonomy object.
+            counts: list with the counters of the samples.
+            accs: list with the accumulated counters of the samples.
+            scores: list with the dicts of scores of the samples.
+            include: root taxids of the subtrees to be collected
+                (all the taxa if it is empty).
+            exclude: root taxids of the subtrees not to be collected.
+
+        Returns: FlatTree ready for subtract(), shape() and collect()
+
+        """
+        index: Dict[TaxId, int] = {}
+        for acc in accs:
+            for taxid in acc:
+                index.setdefault(taxid, len(index))
+        taxids: List[TaxId] = list(index)
+        parent_tids: List[TaxId] = [taxonomy.parents.get(taxid, taxid)
+                                    for taxid in taxids]
+        parents: np.ndarray = np.array(
+            [-1 if ptid == taxid else index[ptid]
+             for taxid, ptid in zip(taxids, parent_tids)], dtype=np.intp)
+        depths: np.ndarray = np.zeros(len(taxids), dtype=np.intp)
+        upper: np.ndarray = parents.copy()
+        active: np.ndarray = upper >= 0
+        while active.any():
+            depths += active
+            upper[active] = parents[upper[active]]
+            active = upper >= 0
+        # Order of each node among its siblings, as in the taxonomy
+        siblings: np.ndarray = np.zeros(len(taxids), dtype=np.intp)
+        families: Dict[int, List[int]] = {}
+        for node, parent in enumerate(parents.tolist()):
+            families.setdefault(parent, []).append(node)
+        for parent, family in families.items():
+            if len(family) > 1:
+                members: Dict[TaxId, int] = {taxids[node]: node
+                                             for node in family}
+                ordered: List[int] = [
+                    members[taxid] for taxid in (
+                        taxonomy.children.get(taxids[parent], ())
+                        if parent >= 0 else members)
+                    if taxid in members]
+                siblings[ordered] = np.arange(len(ordered))
+        order: np.ndarray = np.lexsort((siblings, parents, depths))
+        position: np.ndarray = np.empty(len(taxids), dtype=np.intp)
+        position[order] = np.arange(len(taxids))
+        taxids = [taxids[node] for node in order.tolist()]
+        index = {taxid: node for node, taxid in enumerate(taxids)}
+        parents = parents[order]
+        parents[parents >= 0] = position[parents[parents >= 0]]
+        # Merge the counts and the scores of the samples
+        abuns: np.ndarray = np.zeros(len(taxids), dtype=np.int64)
+        node_scores: np.ndarray = np.full(len(taxids), np.nan)
+        for cnts, scos in zip(counts, scores):
+            np.add.at(abuns, np.array([index[taxid] for taxid in cnts],
+                                      dtype=np.intp),
+                      np.array(list(cnts.values()), dtype=np.int64))
+            node_scores[np.array([index[taxid] for taxid in scos],
+                                 dtype=np.intp)] = [
+                np.nan if score is NO_SCORE else score
+                for score in scos.values()]
+        flat = cls(taxids, parents.tolist(), depths[order].tolist(),
+                   abuns, node_scores)
+        flat.ranks = [taxonomy.get_rank(taxid) for taxid in taxids]
+        # Nodes collected, as in from_growth()
+        included: np.ndarray = np.fromiter(
+            (not include or taxid in include for taxid in taxids),
+            dtype=np.bool_, count=len(taxids))
+        excluded: np.ndarray = np.fromiter(
+            (taxid in exclude for taxid in taxids),
+            dtype=np.bool_, count=len(taxids))
+        collected: np.ndarray = included & ~excluded
+        for level in flat.levels[1:]:
+            collected[level] = ((collected[flat.parents[level]]
+                                 | included[level]) & ~excluded[level])
+        flat.collected = collected
+        return flat
+
+    def collect(self,
+                kept: np.ndarray,
+                counts: np.ndarray,
+                accs: np.ndarray,
+                scores: np.ndarray,
+                out: SampleDataByTaxId) -> None:
+        """
+        Populate the output with the results of a pass, no TaxTree.
+
+        The nodes kept and collected (if flagged) are populated in the
+        output, as TaxTree.populate() does.
+
+        Args:
+            kept: Array flagging the nodes kept after pruning.
+            counts: Array with the counts of the nodes.
+            accs: Array with the accumulated counts of the nodes.
+            scores: Array with the scores of the nodes.
+            out: I/O object, at 1st entry should be empty.
+
+        Returns: None
+
+        """
+        selected: np.ndarray = kept.copy()
+        if self.collected is not None:
+            selected &= self.collected
+        nodes: List[int] = np.flatnonzero(selected).tolist()
+        taxids: List[TaxId] = [self.taxids[node] for node in nodes]
+        if out.counts is not None:
+            out.counts.update(dict(zip(taxids, counts[nodes].tolist())))
+        if out.ranks is not None:
+            out.ranks.update({self.taxids[node]: self.ranks[node]
+                              for node in nodes})
+        if out.scores is not None:
+            out.scores.update({taxid: score for taxid, score
+                               in zip(taxids, scores[nodes].tolist())
+                               if score == score})  # Not NaN
+        if out.accs is not None:
+            out.accs.update(dict(zip(taxids, accs[nodes].tolist())))
+
+    def fold_scores(self,
+                    children: np.ndarray,
+                    accs: np.ndarray,
+                    scores: np.ndarray,
+                    neutral_nan: bool = True) -> None:
+        """
+        Fold scores and accumulated counts of children into parents.
+
+        For every parent, its children are folded sequentially, in
+        order, with a weighted mean of the scores by the accumulated
+        counts. The folds of different parents are vectorized in
+        rounds: the k-th child of every parent is folded in round k.
+
+        Args:
+            children: Indices of the children to fold, in preorder.
+            accs: Input/Output array with the accumulated counts.
+            scores: Input/Output array with the scores.
+            neutral_nan: if True (default), a NaN (NO_SCORE) score
+                does not change the other one in the mean, as in
+                allin1; if False, it is propagated as in prune.
+
+        Returns: None
+
+        """
+        if not children.size:
+            return
+        parents: np.ndarray = self.parents[children]
+        first: np.ndarray = np.empty(children.size, dtype=np.bool_)
+        first[0] = True
+        np.not_equal(parents[1:], parents[:-1], out=first[1:])
+        starts: np.ndarray = np.flatnonzero(first)
+        position: np.ndarray = (np.arange(children.size)
+                                - starts[np.cumsum(first) - 1])
+        order: np.ndarray = np.argsort(position, kind='mergesort')
+        bounds: np.ndarray = np.searchsorted(
+            position[order], np.arange(position.max() + 2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for rnd in range(len(bounds) - 1):
+                selected: np.ndarray = order[bounds[rnd]:bounds[rnd + 1]]
+                if selected.size < self.MIN_FOLD_ROUND:
+                    break
+                chld: np.ndarray = children[selected]
+                prnt: np.ndarray = parents[selected]
+                cnt1: np.ndarray = accs[prnt]
+                sco1: np.ndarray = scores[prnt]
+                cnt2: np.ndarray = accs[chld]
+                sco2: np.ndarray = scores[chld]
+                total: np.ndarray = cnt1 + cnt2
+                mean: np.ndarray = (cnt1 * sco1 + cnt2 * sco2) / total
+                if neutral_nan:
+                    mean = np.where(np.isnan(sco1), sco2,
+                                    np.where(np.isnan(sco2), sco1, mean))
+                update: np.ndarray = total != 0
+                scores[prnt[update]] = mean[update]
+                accs[prnt] = total
+            else:
+                return
+        # Remaining children (of few parents with many) folded in Python
+        remaining: List[int] = sorted(order[bounds[rnd]:].tolist())
+        for chld, prnt in zip(children[remaining].tolist(),
+                              parents[remaining].tolist()):
+            cnt1, cnt2 = int(accs[prnt]), int(accs[chld])
+            sco1, sco2 = float(scores[prnt]), float(scores[chld])
+            if cnt1 + cnt2:
+                if neutral_nan and sco1 != sco1:  # NaN
+                    scores[prnt] = sco2
+                elif not neutral_nan or sco2 == sco2:  # Not NaN
+                    scores[prnt] = (cnt1 * sco1 + cnt2 * sco2) / (cnt1 + cnt2)
+            accs[prnt] = cnt1 + cnt2
+
+    def excluded_by(self,
+                    exclude: Union[Tuple, Set[TaxId]],
+                    ) -> np.ndarray:
+        """
+        Flag the nodes in the subtrees of some taxa (except the top node).
+
+        Args:
+            exclude: root taxids of the subtrees to be flagged.
+
+        Returns:
+            Boolean array flagging the nodes, suitable as the excluded
+            argument of allin1_pass().
+
+        """
+        excluded: np.ndarray = np.fromiter(
+            (taxid in exclude for taxid in self.taxids),
+            dtype=np.bool_, count=len(self))
+        excluded[0] = False
+        for level in self.levels[1:]:  # Top-down propagation
+            excluded[level] |= excluded[self.parents[level]]
+        return excluded
+
+    def allin1_pass(self,
+                    min_taxa: int = 1,
+                    excluded: np.ndarray = None,
+                    ) -> Tuple[np.ndarray, np.ndarray,
+                               np.ndarray, np.ndarray]:
+        """
+        Bottom-up pruning and accumulation with the allin1 algorithm.
+
+        Args:
+            min_taxa: minimum taxa to avoid pruning/collapsing
+                one level to the parent one.
+            excluded: optional boolean array flagging the nodes
+                (with all their subtree) excluded from the pass.
+
+        Returns:
+            Arrays with the kept nodes flag, counts, accumulated
+            counts and scores.
+
+        """
+        counts: np.ndarray = self.counts.copy()
+        accs: np.ndarray = self.counts.copy()
+        scores: np.ndarray = self.scores.copy()
+        kept: np.ndarray = np.ones(len(self), dtype=np.bool_)
+        if excluded is not None:
+            kept &= ~excluded
+        for level in reversed(self.levels[1:]):
+            level = level[kept[level]]
+            child_accs: np.ndarray = accs[level]
+            pruned: np.ndarray = ((child_accs < min_taxa)
+                                  | self.rank_prune[level])
+            # Pruned leaves saving their data in the parent
+            saved: np.ndarray = (pruned & (child_accs > 0)
+                                 & self.save_pruned[level])
+            kept[level[pruned]] = False
+            np.add.at(counts, self.parents[level[saved]],
+                      counts[level[saved]])
+            self.fold_scores(level[~pruned | saved], accs, scores)
+        return kept, counts, accs, scores
+
+    def prune(self,
+              min_taxa: int = 1,
+              min_rank: Rank = None,
+              collapse: bool = True,
+              ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Bottom-up pruning/collapsing of low abundant taxa.
+
+        Only leaves (maybe after pruning their branches) are pruned, if
+        they have less counts than min_taxa or their rank (or the one
+        of their parent) is not above min_rank. With collapse, the
+        counts and score of a pruned leaf are folded into its parent.
+
+        Args:
+            min_taxa: minimum taxa to avoid pruning/collapsing
+                one level to the parent one.
+            min_rank: if any, minimum Rank allowed in the tree.
+            collapse: selects if a lower level should be accumulated in
+                the higher one before pruning a node (do so by default).
+
+        Returns:
+            Arrays with the kept nodes flag, counts and scores.
+
+        """
+        counts: np.ndarray = self.counts.copy()
+        scores: np.ndarray = self.scores.copy()
+        kept: np.ndarray = np.ones(len(self), dtype=np.bool_)
+        branches: np.ndarray = np.zeros(len(self), dtype=np.intp)
+        rank_prune: np.ndarray = np.zeros(len(self), dtype=np.bool_)
+        if min_rank:
+            rank_prune[1:] = [
+                rank < min_rank or self.ranks[parent] <= min_rank
+                for rank, parent in zip(self.ranks[1:],
+                                        self.parents[1:].tolist())]
+        for level in reversed(self.levels[1:]):
+            # Only leaves (maybe after pruning their branches) are pruned
+            pruned: np.ndarray = ((branches[level] == 0)
+                                  & ((counts[level] < min_taxa)
+                                     | rank_prune[level]))
+            kept[level[pruned]] = False
+            np.add.at(branches, self.parents[level[~pruned]], 1)
+            if collapse:
+                self.fold_scores(level[pruned], counts, scores,
+                                 neutral_nan=False)
+        return kept, counts, scores
+
+    def subtract(self) -> np.ndarray:
+        """
+        Bottom-up subtraction of counts of lower levels from higher ones.
+
+        The counts are assumed accumulated before; if the counts of a
+        node are less than the ones below, they are kept unchanged.
+
+        Returns:
+            Array with the counts.
+
+        """
+        counts: np.ndarray = self.counts.copy()
+        below: np.ndarray = np.zeros(len(self), dtype=np.int64)
+        for level in reversed(self.levels):
+            subtracted: np.ndarray = counts[level] >= below[level]
+            output: np.ndarray = np.where(subtracted, counts[level],
+                                          counts[level] + below[level])
+            counts[level] -= np.where(subtracted, below[level], 0)
+            if level is not self.levels[0]:
+                np.add.at(below, self.parents[level], output)
+        return counts
+
+    def shape(self,
+              counts: np.ndarray = None,
+              scores: np.ndarray = None,
+              ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Bottom-up accumulation of counts and score.
+
+        The counts are accumulated in the higher levels, and the score
+        of the nodes without counts directly assigned is calculated
+        from their (non-empty) children, weighted by accumulated counts.
+
+        Args:
+            counts: optional array with the counts, to be used instead
+                of the ones of the tree (e.g. after pruning, with
+                zeros for the pruned nodes).
+            scores: optional array with the scores, likewise.
+
+        Returns:
+            Arrays with the accumulated counts and scores.
+
+        """
+        if counts is None:
+            counts = self.counts
+        if scores is None:
+            scores = self.scores
+        accs: np.ndarray = counts.copy()
+        scores = scores.copy()
+        summed: np.ndarray = np.zeros(len(self), dtype=np.float64)
+        unassigned: np.ndarray = counts == 0
+        for level in reversed(self.levels):
+            # Score of nodes without counts from the (non empty) children
+            update: np.ndarray = level[unassigned[level] & (accs[level] > 0)]
+            scores[update] = summed[update]
+            if level is self.levels[0]:
+                break
+            np.add.at(accs, self.parents[level], accs[level])
+            level = level[accs[level] > 0]
+            parents: np.ndarray = self.parents[level]
+            np.add.at(summed, parents,
+                      scores[level] * accs[level] / accs[parents])
+        return accs, scores
+
+
 class TaxTree(dict):
     """Nodes of a taxonomical tree"""
 
@@ -152,17 +772,21 @@ class TaxTree(dict):
                just_min_rank: bool = False,
                include: Union[Tuple, Set[TaxId]] = (),
                exclude: Union[Tuple, Set[TaxId]] = (),
-               out: SampleDataByTaxId = None,
-               _path: List[TaxId] = None) -> Union[int, None]:
+               out: SampleDataByTaxId = None) -> Union[int, None]:
         """
-        Recursively build a taxonomy tree.
+        Build a taxonomy tree, pruning and accumulating in a single step.
+
+        The skeleton of the tree is built as a FlatTree and then the
+        pruning of the low abundant taxa, the accumulation of counts
+        and the weighted mean of scores are all done bottom-up in a
+        vectorized pass (see FlatTree.allin1_pass).
 
         Args:
             taxonomy: Taxonomy object.
             counts: counter for taxids with their abundances.
             scores: optional dict with the score for each taxid.
             ancestors: optional set of ancestors.
-            tid: It's ROOT by default for the first/base method call
+            tid: It's ROOT by default for the base of the tree
             min_taxa: minimum taxa to avoid pruning/collapsing
                 one level to the parent one.
             min_rank: if any, minimum Rank allowed in the TaxTree.
@@ -172,127 +796,214 @@ class TaxTree(dict):
                 included (except explicitly excluded).
             exclude: root taxid of the subtrees to be excluded
             out: Optional I/O object, at 1st entry should be empty.
-            _path: list used by the recursive algorithm to avoid loops
 
         Returns: Accumulated counts of new node (or None for no node)
 
         """
+        flat: FlatTree = FlatTree.from_sample(
+            taxonomy=taxonomy, counts=counts, scores=scores,
+            ancestors=ancestors, tid=tid, min_rank=min_rank,
+            just_min_rank=just_min_rank, include=include, exclude=exclude)
+        kept, new_counts, accs, new_scores = flat.allin1_pass(min_taxa)
+        self.populate(flat, kept, new_counts, accs, new_scores, out)
+        return self[tid].acc
 
-        def populate_output(taxid: TaxId, source: TaxTree) -> None:
-            """Populate the output structure"""
-            nonlocal out
-            if out.counts is not None:
-                out.counts[taxid] = source[taxid].counts
-            if out.ranks is not None:
-                out.ranks[taxid] = source[taxid].rank
-            if out.scores is not None and source[taxid].score != NO_SCORE:
-                out.scores[taxid] = source[taxid].score
-            if out.accs is not None:
-                out.accs[taxid] = source[taxid].acc
+    def allin1_from(self,
+                    flat: FlatTree,
+                    min_taxa: int = 1,
+                    exclude: Union[Tuple, Set[TaxId]] = (),
+                    out: SampleDataByTaxId = None) -> Union[int, None]:
+        """
+        Like allin1(), but reusing the skeleton of a tree already built.
 
-        # Checks and initializations in the first call to the function
-        if not _path:
-            _path = []
-            if not counts:
-                counts = col.Counter({ROOT: 1})
-            if not scores:
-                scores = {}
-            if min_rank is None and just_min_rank:
-                raise RuntimeError('allin1: just_min_rank without min_rank')
-            if not ancestors:
-                ancestors, _ = taxonomy.get_ancestors(counts.keys())
+        The same FlatTree (see FlatTree.from_sample) can be used for
+        several trees of the same sample that just differ in the
+        excluded taxa: the excluded subtrees are masked in the pass.
 
-        if tid in _path:  # Return if loop for repeated taxid (like root)
-            return None
+        Args:
+            flat: FlatTree with the skeleton of the tree.
+            min_taxa: minimum taxa to avoid pruning/collapsing
+                one level to the parent one.
+            exclude: root taxid of the subtrees to be excluded
+            out: Optional I/O object, at 1st entry should be empty.
 
-        rank: Rank = taxonomy.get_rank(tid)
-        parent_rank: Rank = None
-        if min_rank:  # Get parent rank (NO_RANK is not an option)
-            if tid == ROOT:
-                parent_rank = Rank.ROOT
-            else:
-                for taxid in reversed(_path):
-                    parent_rank = taxonomy.get_rank(taxid)
-                    if parent_rank is not Rank.NO_RANK:
-                        break
-        abun: int = 0
-        # For assigning counts, check just_min_rank conditions and,
-        #  if include list, check if any include taxon is in _path
-        if ((not just_min_rank or rank <= min_rank or parent_rank <= min_rank)
-                and (not include or any(
-                    [tid in include for tid in _path + [tid]]))):
-            abun = counts.get(tid, 0)
-        self[tid] = TaxTree(counts=abun,
-                            score=scores.get(tid, NO_SCORE),
-                            rank=rank,
-                            acc=abun)
-        if tid not in taxonomy.children:
-            return self[tid].acc
-
-        # Taxid has children (is a branch)
-        for chld in taxonomy.children[tid]:
-
-            def update_score_and_acc(chld: TaxId, child_acc: int) -> None:
-                """Update score and then accumulated counts of self[tid]"""
-
-                def swmean(cnt1: int, sco1: Score, cnt2: int,
-                           sco2: Score) -> Score:
-                    """Weighted mean of scores by counts"""
-                    if sco1 == NO_SCORE:
-                        return sco2
-                    elif sco2 == NO_SCORE:
-                        return sco1
-                    return Score((cnt1 * sco1 + cnt2 * sco2) / (cnt1 + cnt2))
-
-                if self[tid].acc + child_acc:
-                    self[tid].score = swmean(
-                        self[tid].acc, self[tid].score,
-                        child_acc, self[tid][chld].score)
-                self[tid].acc += child_acc
-
-            # If not an ancestor or excluded taxa, do not create child
-            if chld not in ancestors or chld in exclude:
-                continue  # Don't create child and continue
-            child_acc: Union[int, None] = self[tid].allin1(
-                taxonomy=taxonomy, counts=counts, scores=scores,
-                ancestors=ancestors, tid=chld,
-                min_taxa=min_taxa, min_rank=min_rank,
-                just_min_rank=just_min_rank, include=include, exclude=exclude,
-                out=out, _path=_path + [tid])
-            if child_acc is None:  # No child created, continue
-                continue
-            rank_prune: bool = False
-            # Set min_rank pruning condition using a robust algorithm
-            #   suitable for multiple eukaryotic NO_RANK sublevels
-            if (min_rank and (self[tid][chld].rank < min_rank or
-                              rank <= min_rank or parent_rank <= min_rank)):
-                rank_prune = True
-            # Check conditions for pruning the leaf
-            if child_acc < min_taxa or rank_prune:
-                # Check conditions for saving the data of leaf in the parent
-                if child_acc > 0 and (
-                        not just_min_rank or (
-                        rank_prune and (
-                        rank == min_rank or parent_rank <= min_rank))):
-                    update_score_and_acc(chld, child_acc)
-                    # Accumulate abundance in higher tax before pruning
-                    self[tid].counts += self[tid][chld].counts
-                pruned: TaxTree = self[tid].pop(chld)  # Prune the leaf
-                assert not pruned, f'{tid}-//->{chld}->{pruned}'
-                continue
-            # Do for non-pruned leafs
-            update_score_and_acc(chld, child_acc)
-            if out:
-                populate_output(chld, self[tid])
-        # If not counts, calculate score from leaves
-        # if not abun and self[tid].acc and self[tid]:
-        #    self[tid].score = sum([
-        #        self[tid][chld].score * self[tid][chld].acc
-        #        / self[tid].acc for chld in self[tid]])
-        # If ROOT, populate results
-        if tid == ROOT and out:
-            populate_output(ROOT, self)
-        return self[tid].acc
+        Returns: Accumulated counts of new node (or None for no node)
+
+        """
+        excluded: np.ndarray = None
+        if exclude:
+            excluded = flat.excluded_by(exclude)
+        kept, new_counts, accs, new_scores = flat.allin1_pass(min_taxa,
+                                                              excluded)
+        self.populate(flat, kept, new_counts, accs, new_scores, out)
+        return self[flat.taxids[0]].acc
+
+    def populate(self,
+                 flat: FlatTree,
+                 kept: np.ndarray,
+                 counts: np.ndarray,
+                 accs: np.ndarray,
+                 scores: np.ndarray,
+                 out: SampleDataByTaxId = None) -> None:
+        """
+        Populate the tree and output with the results of a FlatTree pass.
+
+        If the FlatTree has flagged the nodes to be collected, just
+        those are populated in the output.
+
+        Args:
+            flat: FlatTree with the skeleton of the tree.
+            kept: Array flagging the nodes kept after pruning.
+            counts: Array with the counts of the nodes.
+            accs: Array with the accumulated counts of the nodes.
+            scores: Array with the scores of the nodes.
+            out: Optional I/O object, at 1st entry should be empty.
+
+        Returns: None
+
+        """
+        nodes: Dict[int, TaxTree] = {-1: self}
+        parents: List[int] = flat.parents.tolist()
+        _counts: List[int] = counts.tolist()
+        _accs: List[int] = accs.tolist()
+        _scores: List[Score] = [NO_SCORE if score != score else score
+                                for score in scores.tolist()]  # NaN
+        indices: List[int] = np.flatnonzero(kept).tolist()
+        if flat.taxids[0] is None:  # The top node stands for this tree
+            nodes[0] = self
+            self.counts = _counts[0]
+            self.score = _scores[0]
+            self.acc = _accs[0]
+            indices = indices[1:]
+        collected: List[bool] = None
+        if out and flat.collected is not None:
+            collected = flat.collected.tolist()
+        for index in indices:
+            taxid: TaxId = flat.taxids[index]
+            node = TaxTree(counts=_counts[index],
+                           score=_scores[index],
+                           rank=flat.ranks[index],
+                           acc=_accs[index])
+            nodes[parents[index]][taxid] = node
+            nodes[index] = node
+            # The base node of the tree is only populated if it is ROOT
+            if (out and (index or taxid == ROOT)
+                    and (collected is None or collected[index])):
+                if out.counts is not None:
+                    out.counts[taxid] = node.counts
+                if out.ranks is not None:
+                    out.ranks[taxid] = node.rank
+                if out.scores is not None and node.score != NO_SCORE:
+                    out.scores[taxid] = node.score
+                if out.accs is not None:
+                    out.accs[taxid] = node.acc
+
+    def grow_prune_shape(self,
+                         taxonomy: Taxonomy,
+                         counts: Counter[TaxId] = None,
+                         scores: Union[Dict[TaxId, Score],
+                                       SharedCounter] = None,
+                         ancestors: Set[TaxId] = None,
+                         min_taxa: int = 1,
+                         min_rank: Rank = None,
+                         collapse: bool = True,
+                         include: Union[Tuple, Set[TaxId]] = (),
+                         exclude: Union[Tuple, Set[TaxId]] = (),
+                         out: SampleDataByTaxId = None) -> None:
+        """
+        Grow, prune, shape and get the taxa of the tree in a single step.
+
+        The taxonomy is traversed just once to grow the tree, then the
+        low abundant taxa are pruned (or collapsed) and the counts and
+        scores accumulated in vectorized passes (see FlatTree.prune
+        and FlatTree.shape). If out is provided, it is populated with
+        the taxa of the tree, as get_taxa() with no depth limits.
+        NO_SCORE scores collapsed by pruning propagate as NO_SCORE.
+
+        Args:
+            taxonomy: Taxonomy object.
+            counts: counter for taxids with their abundances.
+            scores: optional dict with the score for each taxid.
+            ancestors: optional set of ancestors.
+            min_taxa: minimum taxa to avoid pruning/collapsing
+                one level to the parent one (0 disables the pruning).
+            min_rank: if any, minimum Rank allowed in the TaxTree.
+            collapse: selects if a lower level should be accumulated in
+                the higher one before pruning a node (do so by default).
+            include: contains the root taxid of the subtrees to be
+                included in the output. If it is empty (default) all
+                the taxa is included (except explicitly excluded).
+            exclude: root taxid of the subtrees to be excluded
+            out: Optional I/O object, at 1st entry should be empty.
+
+        Returns: None
+
+        """
+        if not counts:
+            counts = col.Counter({ROOT: 1})
+        if not scores:
+            scores = {}
+        if not ancestors:
+            ancestors, _ = taxonomy.get_ancestors(counts.keys())
+        flat: FlatTree = FlatTree.from_growth(
+            taxonomy=taxonomy, counts=counts, scores=scores,
+            ancestors=ancestors, include=include, exclude=exclude)
+        kept, new_counts, new_scores = flat.prune(min_taxa, min_rank,
+                                                  collapse)
+        accs, new_scores = flat.shape(np.where(kept, new_counts, 0),
+                                      new_scores)
+        kept &= accs > 0
+        kept[0] = True
+        self.populate(flat, kept, new_counts, accs, new_scores, out)
+
+    def grow_subtract_shape(self,
+                            taxonomy: Taxonomy,
+                            counts: Counter[TaxId] = None,
+                            scores: Union[Dict[TaxId, Score],
+                                          SharedCounter] = None,
+                            ancestors: Set[TaxId] = None,
+                            include: Union[Tuple, Set[TaxId]] = (),
+                            exclude: Union[Tuple, Set[TaxId]] = (),
+                            out: SampleDataByTaxId = None) -> None:
+        """
+        Grow, subtract, shape and get the taxa of the tree in one step.
+
+        The taxonomy is traversed just once to grow the tree, then the
+        counts of lower levels are subtracted from higher ones and the
+        counts and scores accumulated again in vectorized passes (see
+        FlatTree.subtract and FlatTree.shape). If out is provided, it
+        is populated with the taxa of the tree, as get_taxa() with no
+        depth limits.
+
+        Args:
+            taxonomy: Taxonomy object.
+            counts: counter for taxids with their (accumulated)
+                abundances.
+            scores: optional dict with the score for each taxid.
+            ancestors: optional set of ancestors.
+            include: contains the root taxid of the subtrees to be
+                included in the output. If it is empty (default) all
+                the taxa is included (except explicitly excluded).
+            exclude: root taxid of the subtrees to be excluded
+            out: Optional I/O object, at 1st entry should be empty.
+
+        Returns: None
+
+        """
+        if not counts:
+            counts = col.Counter({ROOT: 1})
+        if not scores:
+            scores = {}
+        if not ancestors:
+            ancestors, _ = taxonomy.get_ancestors(counts.keys())
+        flat: FlatTree = FlatTree.from_growth(
+            taxonomy=taxonomy, counts=counts, scores=scores,
+            ancestors=ancestors, include=include, exclude=exclude)
+        new_counts: np.ndarray = flat.subtract()
+        accs, new_scores = flat.shape(new_counts)
+        kept: np.ndarray = accs > 0
+        kept[0] = True
+        self.populate(flat, kept, new_counts, accs, new_scores, out)
 
     def get_lineage(self,
                     parents: Parents,
@@ -302,6 +1013,11 @@ class TaxTree(dict):
         Build dict with taxid as keys, whose values are the list of
             nodes in the tree in the path from root to such a taxid.
 
+        The lineages are obtained following the parent pointers and
+        memoizing the lineage of every node visited, so the shared
+        prefixes are traced just once and the cost for all the taxa
+        of a sample is linear in the size of the tree.
+
         Args:
             parents: dictionary of taxids parents.
             taxids: collection with the taxids to process.
@@ -313,13 +1029,26 @@ class TaxTree(dict):
         output = io.StringIO(newline='')
         output.write('  \033[90mGetting lineage of taxa...\033[0m')
         nodes_traced: Dict[TaxId, List[TaxId]] = {}
+        in_tree: Set[TaxId] = self.get_nodes()
+        lineages: Dict[TaxId, Tuple[TaxId, ...]] = {ROOT: (ROOT,)}
         for tid in taxids:
             if tid == ROOT:
                 nodes_traced[ROOT] = [ROOT, ]  # Root node special case
             elif tid in parents:
-                nodes: List[TaxId] = []
-                if self.trace(tid, nodes):  # list nodes is populated
-                    nodes_traced[tid] = nodes
+                path: List[TaxId] = []
+                taxid: TaxId = tid
+                while taxid not in lineages:  # Climb up to a traced node
+                    if taxid not in in_tree or taxid not in parents:
+                        break
+                    path.append(taxid)
+                    taxid = parents[taxid]
+                else:  # Memoize the lineage of every new node in the path
+                    lineage: Tuple[TaxId, ...] = lineages[taxid]
+                    for node in reversed(path):
+                        lineage += (node,)
+                        lineages[node] = lineage
+                if tid in lineages:
+                    nodes_traced[tid] = list(lineages[tid])
                 else:
                     output.write('[\033[93mWARNING\033[0m: Failed tracing '
                                  f'of taxid {tid}: missing in tree]\n')
@@ -329,6 +1058,16 @@ class TaxTree(dict):
         output.write('\033[92m OK! \033[0m\n')
         return output.getvalue(), nodes_traced
 
+    def get_nodes(self) -> Set[TaxId]:
+        """Get the set of taxids of all the nodes in the tree"""
+        nodes: Set[TaxId] = set()
+        branches: List[TaxTree] = [self]
+        while branches:  # Iterative traversal to avoid deep recursion
+            branch: TaxTree = branches.pop()
+            nodes.update(branch)
+            branches.extend(branch[tid] for tid in branch if branch[tid])
+        return nodes
+
     def get_taxa(self,
                  abundance: Counter[TaxId] = None,
                  accs: Counter[TaxId] = None,
@@ -447,201 +1186,6 @@ class TaxTree(dict):
                                      taxid=child,
                                      _path=_path + [taxid])
 
-    def prune(self,
-              min_taxa: int = 1,
-              min_rank: Rank = None,
-              collapse: bool = True,
-              debug: bool = False) -> bool:
-        """
-        Recursively prune/collapse low abundant taxa of the TaxTree.
-
-        Args:
-            min_taxa: minimum taxa to avoid pruning/collapsing
-                one level to the parent one.
-            min_rank: if any, minimum Rank allowed in the TaxTree.
-            collapse: selects if a lower level should be accumulated in
-                the higher one before pruning a node (do so by default).
-            debug: increase output verbosity (just for debug)
-
-        Returns: True if this node is a leaf
-
-        """
-        for tid in list(self):  # Loop if this node has subtrees
-            if (self[tid]  # If the subtree has branches,
-                    and self[tid].prune(min_taxa, min_rank, collapse, debug)):
-                # The pruned subtree keeps having branches (still not a leaf!)
-                if debug:
-                    print(f'[NOT pruning branch {tid}, '
-                          f'counts={self[tid].counts}]', end='')
-            else:  # self[tid] is a leaf (after pruning its branches or not)
-                if (self[tid].counts < min_taxa  # Not enough counts, or check
-                        or (min_rank  # if min_rank is set, then check if level
-                            and (self[tid].rank < min_rank  # is lower or
-                                 or self.rank <= min_rank))):  # other test
-                    if collapse:
-                        collapsed_counts: int = self.counts + self[tid].counts
-                        if collapsed_counts:  # Average the collapsed score
-                            self.score = ((self.score * self.counts
-                                           + self[tid].score * self[
-                                               tid].counts)
-                                          / collapsed_counts)
-                            # Accumulate abundance in higher tax
-                            self.counts = collapsed_counts
-                    else:  # No collapse: update acc counts erasing leaf counts
-                        if self.acc > self[tid].counts:
-                            self.acc -= self[tid].counts
-                        else:
-                            self.acc = 0
-                    if debug and self[tid].counts:
-                        print(f'[Pruning branch {tid}, '
-                              f'counts={self[tid].counts}]', end='')
-                    self.pop(tid)  # Prune leaf
-                elif debug:
-                    print(f'[NOT pruning leaf {tid}, '
-                          f'counts={self[tid].counts}]', end='')
-        return bool(self)  # True if this node has branches (is not a leaf)
-
-    def shape(self) -> None:
-        """
-        Recursively populate accumulated counts and score.
-
-        From bottom to top, accumulate counts in higher taxonomical
-        levels, so populate self.acc of the tree. Also calculate
-        score for levels that have no reads directly assigned
-        (unassigned = 0). It eliminates leaves with no accumulated
-        counts. With all, it shapes the tree to the most useful form.
-
-        """
-        self.acc = self.counts  # Initialize accumulated with unassigned counts
-        for tid in list(self):  # Loop if this node has subtrees
-            self[tid].shape()  # Accumulate for each branch/leaf
-            if not self[tid].acc:
-                self.pop(tid)  # Prune empty leaf
-            else:
-                self.acc += self[tid].acc  # Acc lower tax acc in this node
-        if not self.counts:
-            # If not unassigned (no reads directly assigned to the level),
-            #  calculate score from leaves, trying different approaches.
-            if self.acc:  # Leafs (at least 1) have accum.
-                self.score = sum([self[tid].score * self[tid].acc
-                                  / self.acc for tid in self])
-            else:  # No leaf with unassigned counts nor accumulated
-                # Currently, do nothing, but another choice is
-                #   just get the averaged score by number of leaves
-                # self.score = sum([self[tid].score
-                #                   for tid in list(self)])/len(self)
-                pass
-
-    def subtract(self) -> int:
-        """
-        Recursively subtract counts of lower levels from higher ones.
-
-        From bottom to top, subtract counts from higher taxonomical
-        levels, under the assumption than they were accumulated before.
-
-        """
-        below: int = 0
-        output: int = 0
-        for tid in list(self):  # Loop if this node has subtrees
-            below += self[tid].subtract()  # Subtract for each branch/leaf
-        if self.counts >= below:
-            output = self.counts
-            self.counts -= below  # Subtract lower taxa counts
-        else:
-            output = self.counts + below
-        return output
-
-    def toxml(self,
-              taxonomy: Taxonomy,
-              krona: KronaTree,
-              node: Elm = None,
-              mindepth: int = 0,
-              maxdepth: int = 0,
-              include: Union[Tuple, Set[TaxId]] = (),
-              exclude: Union[Tuple, Set[TaxId]] = (),
-              _in_branch: bool = False
-              ) -> None:
-        """
-        Recursively convert to XML between min and max depth levels.
-
-        Args:
-            taxonomy: Taxonomy object.
-            krona: Input/Output KronaTree object to be populated.
-            node: Base node (None to use the root of krona argument).
-            mindepth: 0 gets the taxa from the very beginning depth.
-            maxdepth: 0 does not stop the search at any depth level.
-            include: contains the root taxid of the subtrees to be
-                included. If it is empty (default) all the taxa is
-                included (except explicitly excluded).
-            exclude: contains the root taxid of the subtrees to be
-                excluded
-            _in_branch: is like a static variable to tell the
-                recursive function that it is in a subtree that is
-                a branch of a taxon in the include list.
-
-        Returns: None
-
-        """
-        mindepth -= 1
-        if maxdepth != 1:
-            maxdepth -= 1
-            for tid in self:
-                in_branch: bool = (
-                        (_in_branch or  # called with flag activated? or
-                         not include or  # include by default? or
-                         (tid in include))  # tid is to be included?
-                        and tid not in exclude  # and not in exclude list
-                )
-                new_node: Elm
-                if mindepth <= 0 and in_branch:
-                    if node is None:
-                        node = krona.getroot()
-                    new_node = krona.node(
-                        node, taxonomy.get_name(tid),
-                        {COUNT: {krona.samples[0]: str(self[tid].acc)},
-                         UNASSIGNED: {krona.samples[0]: str(self[tid].counts)},
-                         TID: str(tid),
-                         RANK: taxonomy.get_rank(tid).name.lower(),
-                         SCORE: {krona.samples[0]: str(self[tid].score)}}
-                    )
-                if self[tid]:
-                    self[tid].toxml(taxonomy,
-                                    krona, new_node,
-                                    mindepth, maxdepth,
-                                    include, exclude,
-                                    in_branch)
-
-    def trace(self,
-              target: TaxId,
-              nodes: List[TaxId],
-              ) -> bool:
-        """
-        Recursively get a list of nodes from self to target taxid.
-
-        Args:
-            target: TaxId of the node to trace
-            nodes: Input/output list of TaxIds: at 1st entry is empty.
-
-        Returns:
-            Boolean about the success of the tracing.
-
-        """
-        target_found: bool = False
-        for tid in self:
-            if self[tid]:
-                nodes.append(tid)
-                if target in self[tid] and target != ROOT:
-                    # Avoid to append more than once the root node
-                    nodes.append(target)
-                    target_found = True
-                    break
-                if self[tid].trace(target, nodes):
-                    target_found = True
-                    break
-                else:
-                    nodes.pop()
-        return target_found
-
 
 class MultiTree(dict):
     """Nodes of a multiple taxonomical tree"""
@@ -757,75 +1301,160 @@ class MultiTree(dict):
                                          taxid=child,
                                          _path=_path + [taxid])
 
-    def toxml(self,
-              taxonomy: Taxonomy,
-              krona: KronaTree,
-              node: Elm = None,
-              ) -> None:
+    def krona_node(self,
+                   tid: TaxId,
+                   taxonomy: Taxonomy,
+                   ) -> Tuple[str, Dict[Attrib, Any]]:
+        """Get the name and values of the Krona node of a child taxon"""
+        return self[tid].krona_values(tid, taxonomy.get_rank(tid).name.lower(),
+                                      taxonomy.get_name(tid))
+
+    def krona_values(self,
+                     tid: TaxId,
+                     rank: str,
+                     name: str,
+                     ) -> Tuple[str, Dict[Attrib, Any]]:
+        """Get the name and values of the Krona node of this taxon"""
+        num_samples = len(self.samples)
+        return (name,
+                {COUNT: {self.samples[i]: str(self.accs[i])
+                         for i in range(num_samples)},
+                 UNASSIGNED: {self.samples[i]: str(self.counts[i])
+                              for i in range(num_samples)},
+                 TID: str(tid),
+                 RANK: rank,
+                 SCORE: {self.samples[i]: (
+                     f'{self.score[i]:.1f}'
+                     if self.score[i] != NO_SCORE else '0')
+                     for i in range(num_samples)},
+                 })
+
+    def iter_krona(self,
+                   taxonomy: Taxonomy,
+                   tids: Iterable[TaxId] = None,
+                   ) -> KronaNodes:
         """
-        Recursive method to generate XML.
+        Generate the Krona nodes of the tree in document order.
+
+        The tree is walked depth-first without recursion, so the Krona
+        nodes may be streamed to the output file without building the
+        whole XML tree in memory (see KronaTree.write_nodes).
 
         Args:
             taxonomy: Taxonomy object.
-            krona: Input/Output KronaTree object to be populated.
-            node: Base node (None to use the root of krona argument).
+            tids: Taxa of the first level to walk (all by default).
 
-        Returns: None
+        Returns: Generator with the name and values of every node when
+            it is opened, and None when it is closed.
 
         """
-        for tid in self:
-            if node is None:
-                node = krona.getroot()
-            num_samples = len(self.samples)
-            new_node: Elm = krona.node(
-                parent=node,
-                name=taxonomy.get_name(tid),
-                values={COUNT: {self.samples[i]: str(self[tid].accs[i])
-                                for i in range(num_samples)},
-                        UNASSIGNED: {self.samples[i]: str(self[tid].counts[i])
-                                     for i in range(num_samples)},
-                        TID: str(tid),
-                        RANK: taxonomy.get_rank(tid).name.lower(),
-                        SCORE: {self.samples[i]: (
-                            f'{self[tid].score[i]:.1f}'
-                            if self[tid].score[i] != NO_SCORE else '0')
-                            for i in range(num_samples)},
-                        }
-            )
-            if self[tid]:
-                self[tid].toxml(taxonomy=taxonomy,
-                                krona=krona,
-                                node=new_node)
-
-    def to_items(self,
-                 taxonomy: Taxonomy,
-                 items: List[Tuple[TaxId, List]],
-                 sample_indexes: List[int] = None
-                 ) -> None:
+        branches: List[Tuple[MultiTree, Iterator[TaxId]]] = [
+            (self, iter(self if tids is None else tids))]
+        while branches:
+            tree, tree_tids = branches[-1]
+            tid: TaxId = next(tree_tids, None)
+            if tid is None:
+                branches.pop()
+                if branches:
+                    yield None  # Close the node of the branch
+                continue
+            yield tree.krona_node(tid, taxonomy)
+            branches.append((tree[tid], iter(tree[tid])))
+
+    def walk(self,
+             taxonomy: Taxonomy,
+             outputs: List[Output],
+             ) -> None:
         """
-        Recursive method to populate a list (used to feed a DataFrame).
+        Walk the tree once to feed all the outputs at the same time.
+
+        The tree is walked depth-first without recursion and the rank
+        and name of every taxon are looked up just once for all the
+        outputs (see recentrifuge.outputs.Output), which are opened
+        before the walk and closed after it. All the opened outputs are
+        closed even if the walk fails, and then the first error is
+        raised (the one of the walk, if any).
 
         Args:
             taxonomy: Taxonomy object.
-            items: Input/Output list to be populated.
-            sample_indexes: Indexes of the samples of interest (for cC)
+            outputs: Outputs to be fed with the nodes.
 
         Returns: None
 
         """
-        for tid in self:
-            list_row: List = []
-            if sample_indexes:
-                for i in sample_indexes:
-                    list_row.append(self[tid].counts[i])
-            else:
-                for i in range(len(self.samples)):
-                    list_row.extend([self[tid].accs[i],
-                                     self[tid].counts[i],
-                                     self[tid].score[i]])
-                list_row.extend([taxonomy.get_rank(tid).name.lower(),
-                                 taxonomy.get_name(tid)])
-            items.append((tid, list_row))
-            if self[tid]:
-                self[tid].to_items(taxonomy=taxonomy, items=items,
-                                   sample_indexes=sample_indexes)
+        opened: List[Output] = []
+        errors: List[Exception] = []
+        try:
+            for output in outputs:
+                output.open()
+                opened.append(output)
+            branches: List[Iterator[Tuple[TaxId, MultiTree]]] = [
+                iter(self.items())]
+            while branches:
+                item: Tuple[TaxId, MultiTree] = next(branches[-1], None)
+                if item is None:
+                    branches.pop()
+                    if branches:
+                        for output in outputs:
+                            output.close_node()
+                    continue
+                tid, node = item
+                rank: str = taxonomy.get_rank(tid).name.lower()
+                name: str = taxonomy.get_name(tid)
+                for output in outputs:
+                    output.open_node(tid, node, rank, name)
+                branches.append(iter(node.items()))
+        finally:  # Close all the outputs even if the walk or any close fails
+            for output in opened:
+                try:
+                    output.close()
+                except Exception as error:  # pylint: disable=broad-except
+                    errors.append(error)
+        if errors:
+            raise errors[0]
+
+    def num_nodes(self) -> int:
+        """Get the number of nodes under this one (without recursion)"""
+        num: int = 0
+        trees: List[MultiTree] = [self]
+        while trees:
+            tree: MultiTree = trees.pop()
+            num += len(tree)
+            trees.extend(tree.values())
+        return num
+
+    def split(self, num_branches: int
+              ) -> Tuple[List[List[TaxId]], List[int], List['MultiTree']]:
+        """
+        Split the tree in branches to be walked independently.
+
+        The biggest branch is split in the ones of its children until
+        there are at least the requested number of branches or the
+        biggest one cannot be further split, so every node not in the
+        resulting branches is an ancestor of them.
+
+        Args:
+            num_branches: Minimum number of branches desired.
+
+        Returns: List with the path (the taxa from the first level) to
+            the root of every branch, list with its size in nodes, and
+            list with the subtree of its root (to be sent on its own).
+
+        """
+        sizes: Dict[TaxId, int] = {tid: 1 + self[tid].num_nodes()
+                                   for tid in self}
+        paths: Dict[TaxId, List[TaxId]] = {tid: [tid] for tid in self}
+        trees: Dict[TaxId, MultiTree] = dict(self)
+        while len(sizes) < num_branches:
+            biggest: TaxId = max(sizes, key=sizes.__getitem__)
+            if not trees[biggest]:
+                break
+            del sizes[biggest]
+            path: List[TaxId] = paths.pop(biggest)
+            tree: MultiTree = trees.pop(biggest)
+            for tid in tree:
+                sizes[tid] = 1 + tree[tid].num_nodes()
+                paths[tid] = path + [tid]
+                trees[tid] = tree[tid]
+        return (list(paths.values()), [sizes[tid] for tid in paths],
+                [trees[tid] for tid in paths])